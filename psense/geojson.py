@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Created: 18 Oct. 2026
+#-------------------------------------------------------------------------------
+# Streaming GeoJSON output. Features are formatted one user at a time, with the
+# coordinates of the user formatted at once, and written to the file as they
+# come. The output is byte for byte the one of the former string-building
+# writers, which pvis loads.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+HEADER = '{"type":"FeatureCollection","features":['
+
+#-------------------------------------------------------------------------------
+
+def format_floats(x):
+    """
+    Format an array of floats as `str` does in Python 2 (12 significant
+    digits, and '.0' appended to integral values).
+    """
+    s = np.char.mod('%.12g', np.asarray(x, dtype=np.float64))
+    plain = (np.char.find(s, '.') < 0) & (np.char.find(s, 'e') < 0) \
+        & (np.char.find(s, 'n') < 0) # nor nan, inf
+    return np.where(plain, np.char.add(s, '.0'), s)
+
+def format_coordinates(lng, lat):
+    """The GeoJSON list of positions "[lng,lat],[lng,lat],..." (no brackets)."""
+    if not len(lng):
+        return ''
+    pairs = np.char.add(np.char.add('[', format_floats(lng)), ',')
+    pairs = np.char.add(np.char.add(pairs, format_floats(lat)), ']')
+    return ','.join(pairs.tolist())
+
+def write_features(fout, features):
+    """
+    Write a FeatureCollection of the feature strings generated by `features`
+    to the open file `fout`, one feature at a time.
+    """
+    first = True
+    for feature in features:
+        if isinstance(feature, unicode):
+            feature = feature.encode('utf-8')
+        fout.write(HEADER + feature if first else "," + feature)
+        first = False
+    # the former writers removed the last character before closing
+    fout.write(HEADER[:-1] + "]}" if first else "]}")
+
+def write_paths(outpath, uids, lat, lng, starts, geomType="LineString"):
+    """
+    Write the reports of each user, laid out contiguously by user (see
+    `psense.stats.group_users`), as a LineString or MultiPoint feature.
+    """
+    def features():
+        for i, (uid, a, b) in enumerate(zip(uids, starts[:-1], starts[1:])):
+            # geojson [lng, lat] standard layout
+            yield '{"type":"Feature","properties":{"number":%s,"id":%s},"geometry":{"type":"%s","coordinates":[%s]}}' \
+                % (i, uid, geomType, format_coordinates(lng[a:b], lat[a:b]))
+
+    with open(outpath, "wt") as fout:
+        write_features(fout, features())
+
+def write_points(outpath, uids, lat, lng):
+    """Write one Point feature per user, e.g. the centers of the users."""
+    lat, lng = format_floats(lat), format_floats(lng)
+    features = ('{"type":"Feature","properties":{"number":%s,"id":%s},"geometry":{"type":"Point","coordinates":[%s, %s]}}' \
+        % (i, uid, lng[i], lat[i]) for i, uid in enumerate(uids)) # [lng, lat] layout
+
+    with open(outpath, "wt") as fout:
+        write_features(fout, features)
+
+#-------------------------------------------------------------------------------
@@ -17,10 +17,12 @@ import numpy as np
 import pandas as pd
 
 from psense.util import *
+from psense.stats import group_users
+from psense.index import UserIndex
 
 # ------------------------------------------------------------------------------
 
-def slow_build_grid(df, bbox=None, gridsize=1.0, lazy=0):
+def slow_build_grid(df, bbox=None, gridsize=1.0, lazy=0, sindex=None):
     """
     Return the cell of size `s` with the highest all-time record count.
 
@@ -31,13 +33,15 @@ def slow_build_grid(df, bbox=None, gridsize=1.0, lazy=0):
         gridsize (float): The gridsize in kilometers.
         lazy (int): The choice of the distance function. Must be in
             [0, 1, 2].
+        sindex (psense.index.SpatialIndex, optional): Spatial index built on
+            `df`, used to count the reports in each cell.
 
     Runtime:
         O(m * n * S), where S is the size of `df` and (m, n) is the dimension of
-        the grid.
+        the grid. O(m * n * log(S)) on average if `sindex` is given.
     """
     if not bbox:
-        bbox = get_bbox(df)
+        bbox = get_bbox(df, sindex)
     W, S, E, N = bbox
     print "Sampling in a (%skm x %skm) box with %skm long steps" % (E - W, N - S, gridsize)
     bottom = S
@@ -48,7 +52,11 @@ def slow_build_grid(df, bbox=None, gridsize=1.0, lazy=0):
         right = min(go_east(bottom, left, gridsize), E)
         while bottom < N - EPSILON: # walk north
             top = min(go_north(bottom, left, gridsize), N)
-            count = len(bound(df, [left, bottom, right, top]))
+            cellbox = [left, bottom, right, top]
+            if sindex is not None:
+                count = sindex.count_bbox(cellbox)
+            else:
+                count = len(bound(df, cellbox))
             traffic[-1].insert(0, count)
             bottom = top
         bottom = S
@@ -73,6 +81,62 @@ def get_max_traffic_cell(grid, all=False):
         i, j = np.unravel_index(m.argmax(), m.shape)
         return [(i, j)]
 
+def od_matrix(g, per_slice=False, loops=True, sparse=False):
+    """
+    Count the transitions between the cells of the consecutive reports of
+    each user.
+
+    Args:
+        g (Grid): A data-populated grid (or TimeGrid, QuadGrid).
+        per_slice (bool, optional): For a TimeGrid, count the transitions
+            separately for each time slice (that of the origin report).
+        loops (bool, optional): Keep the transitions within the same cell.
+        sparse (bool, optional): Return a scipy.sparse matrix (one per time
+            slice if `per_slice`) instead of a DataFrame. Requires scipy.
+
+    Returns:
+        A DataFrame with the columns 'origin', 'destination' and 'count' (and
+        't' first if `per_slice`), where cells are numbered row by row, i.e.
+        cell (i, j) is number i * g.shape[-1] + j.
+
+    Runtime:
+        O(n * log(n)), where n is the number of reports in the grid.
+    """
+    if g.df is None or "icell" not in g.df:
+        raise ValueError("The grid must be populated (see 'Grid.build')")
+    uids, starts, order = group_users(g.df, sort_time=True)
+    # (i, j), (t, i, j) or (level, i, j) cells, also without reports
+    width = 3 if isinstance(g, QuadGrid) else len(g.shape)
+    cells = np.array(list(g.df["icell"]), dtype=np.int64).reshape(len(order), width)[order]
+    nrows, ncols = g.shape[-2:]
+    if isinstance(g, QuadGrid): # top-level cell of each leaf
+        cells = np.column_stack((cells[:, 1] >> cells[:, 0], cells[:, 2] >> cells[:, 0]))
+    flat = cells[:, -2] * ncols + cells[:, -1]
+    ncells = nrows * ncols
+
+    user = np.repeat(np.arange(len(uids)), np.diff(starts))
+    same = user[1:] == user[:-1]
+    origin, destination = flat[:-1][same], flat[1:][same]
+    per_slice = per_slice and cells.shape[1] == 3
+    t = cells[:-1, 0][same] if per_slice else np.zeros(len(origin), dtype=np.int64)
+    if not loops:
+        keep = origin != destination
+        origin, destination, t = origin[keep], destination[keep], t[keep]
+
+    keys, counts = np.unique((t * ncells + origin) * ncells + destination, return_counts=True)
+    od = pd.DataFrame({"t": keys // (ncells * ncells), "origin": keys // ncells % ncells,
+        "destination": keys % ncells, "count": counts},
+        columns=["t", "origin", "destination", "count"])
+    if not per_slice:
+        del od["t"]
+    if sparse:
+        from scipy.sparse import coo_matrix
+        tocsr = lambda f: coo_matrix((f["count"].values, (f["origin"].values, f["destination"].values)), shape=(ncells, ncells)).tocsr()
+        if per_slice:
+            return [tocsr(od[od.t == k]) for k in range(g.shape[0])]
+        return tocsr(od)
+    return od
+
 def get_max_traffic_location(df, bbox=None, gridsize=1.0, lazy=0):
     """
     Return the midpoint of the cell of gridsize `gridsize` with the highest all-time record count.
@@ -119,6 +183,8 @@ class Grid(object):
         self._gridsize = None
         self._data = data
         self._sizematrix = sizematrix
+        self._sat = None # summed-area table, see `sat`
+        self._cutcache = {} # cell boundaries, see `_cuts`
         if data is not None and not isinstance(data, SparseArray):
             raise TypeError("'data' must be of type SparseArray")
         if sizematrix is not None and not isinstance(sizematrix, np.matrixlib.defmatrix.matrix):
@@ -212,8 +278,56 @@ class Grid(object):
 
         index = tuple(index)
         self.data.insert(index, P)
+        self._sat = None
         return index
 
+    def _offsets(self, P):
+        """Distances (north, east) in km of `P` from the SW corner of the bbox."""
+        W, S, E, N = self.bbox
+        return (self._distance((S, W), (P.lat, W)), self._distance((S, W), (S, P.lng)))
+
+    def _cuts(self, axis):
+        """
+        Latitudes (axis 0) or longitudes (axis 1) at which the offset of a
+        point from the SW corner reaches k * gridsize, for k = 1, 2, ...,
+        found by bisection on the grid's distance function, so that
+        `locate` agrees with `add_point`.
+        """
+        key = (axis, tuple(self.bbox), self.gridsize, self.lazy)
+        if key not in self._cutcache:
+            W, S, E, N = self.bbox
+            if axis == 0:
+                offset, n, lo0, hi0 = lambda x: self._distance((S, W), (x, W)), self.rowlength, S, N
+            else:
+                offset, n, lo0, hi0 = lambda x: self._distance((S, W), (S, x)), self.collength, W, E
+            cuts = []
+            for k in range(1, n):
+                lo, hi = (cuts[-1] if cuts else lo0), hi0
+                while True:
+                    mid = (lo + hi) / 2.0
+                    if not lo < mid < hi:
+                        break
+                    if int(offset(mid) / self.gridsize) >= k:
+                        hi = mid
+                    else:
+                        lo = mid
+                cuts.append(hi)
+            self._cutcache[key] = np.array(cuts, dtype=np.float64)
+        return self._cutcache[key]
+
+    def locate(self, lat, lng):
+        """
+        Return the cell indices (rows, columns) of arrays of points inside
+        the bbox, as `add_point` would, without inserting them.
+
+        Runtime:
+            O(n * log(m + n)) for n points on a (m, n) grid, plus a one-time
+            O((m + n) * 64) distance evaluations for the cell boundaries.
+        """
+        k = np.searchsorted(self._cuts(0), lat, side='right')
+        j = np.searchsorted(self._cuts(1), lng, side='right')
+        return self.rowlength - k - 1, j
+
     def add_cell_in_df(self, P):
         df.loc[(df.created_at == P.ts) & (df.index == P.user_id), "icell"] = self.add_point(P)
 
@@ -231,21 +345,37 @@ class Grid(object):
             raise ValueError("DataFrame 'df' has not been set")
         if uid not in self.df.index:
             raise ValueError("%s not in 'df'" % uid)
-        rawcells = self.df.loc[uid, "icell"]
-        if isinstance(rawcells, tuple):
-            return [rawcells]
-        else:
-            return list(set(self.df.loc[uid, "icell"]))
+        # a list indexer always gives a Series (and works on categorical indices)
+        return list(set(self.df.loc[[uid], "icell"]))
 
     def get_points(self, cellindex):
         return self.data[cellindex]
 
+    def _resized(self, gridsize):
+        """Return an empty grid with the same extent and the given gridsize."""
+        return self.__class__(self.bbox, gridsize=gridsize, lazy=self.lazy)
+
+    def count_box(self, lo, hi):
+        """
+        Count the points in the box of cells lo <= index < hi, e.g.
+        `g.count_box((i0, j0), (i1, j1))`, in constant time.
+        """
+        return box_sum(self.sat, lo, hi)
+
+    def count_boxes(self, lo, hi):
+        """
+        Count the points in a batch of boxes of cells, given as (k, ndim)
+        arrays of lower (inclusive) and upper (exclusive) cell indices.
+        """
+        return box_sum(self.sat, np.atleast_2d(lo), np.atleast_2d(hi))
+
     # -- CLASS METHODS --
     @classmethod
-    def build(cls, df, bbox=None, gridsize=1.0, lazy=0):
+    def build(cls, df, bbox=None, gridsize=1.0, lazy=0, sindex=None):
         """
         Build a two-dimensional grid from the locations of each point of the
-        DataFrame `df`, and count the occurrences in each cell.
+        DataFrame `df`, and count the occurrences in each cell. If a
+        `SpatialIndex` on `df` is given, it is used to bound `df` to `bbox`.
 
         Runtime:
             O(S + (m * n)), where S is the size of `df` and (m, n) is the
@@ -256,12 +386,12 @@ class Grid(object):
         g = cls(bbox, gridsize=gridsize, lazy=lazy)
         # define row vector function
         def add_point(row):
-            metadata = row.loc[:"text"].to_dict()
+            metadata = row_metadata(row)
             P = Point((row.lat, row.lng), metadata=metadata)
             # modify g and return the cell index
             return [g.add_point(P)] # passes a list because of pd.Timestamp bug
         # bound dataframe to bbox (and make 'user_id' a column)
-        df_bounded = bound(df, bbox).reset_index()
+        df_bounded = bound(df, bbox, sindex).reset_index()
         # loop through the dataframe and register each report in the grid
         # Extract the results of the first (any) column (pd.Timestamp
         # workaround)
@@ -272,6 +402,29 @@ class Grid(object):
         g.df = df_bounded
         return g
 
+    @classmethod
+    def build_chunks(cls, chunks, bbox, gridsize=1.0, lazy=0):
+        """
+        Count the reports of an iterable of DataFrames (e.g. the chunks of
+        `psense.io_csv.iter_chunks`) in each cell, holding one chunk in
+        memory at a time.
+
+        The resulting grid only holds the counts (`sizematrix`, `countarray`,
+        `sat`, `count_box`): neither the points nor `df` are kept.
+
+        Runtime:
+            O(S * log(m + n)), where S is the number of reports and (m, n) is
+            the dimension of the grid.
+        """
+        g = cls(bbox, gridsize=gridsize, lazy=lazy)
+        counts = np.zeros(g.shape, dtype=np.int64)
+        for chunk in chunks:
+            chunk = bound(chunk, bbox)
+            i, j = g.locate(np.asarray(chunk["lat"]), np.asarray(chunk["lng"]))
+            counts += np.bincount(i * g.shape[1] + j, minlength=counts.size).reshape(counts.shape)
+        g._sizematrix = np.matrix(counts)
+        return g
+
     # -- PROPERTIES --
     @property
     def gridsize(self):
@@ -340,6 +493,20 @@ class Grid(object):
                 m[i] = len(self.data[i])
             return m
 
+    @property
+    def countarray(self):
+        """Number of points in each cell, as a numpy.ndarray of shape `shape`."""
+        return np.asarray(self.sizematrix)
+
+    @property
+    def sat(self):
+        """
+        Summed-area table of `countarray`, rebuilt lazily after inserts.
+        """
+        if self._sat is None or self._sat.shape != tuple(n + 1 for n in self.shape):
+            self._sat = summed_area_table(self.countarray)
+        return self._sat
+
     @property
     def columns(self):
         if self.gridsize and (self._columns is None or self._updateCols):
@@ -413,6 +580,286 @@ class Grid(object):
         else:
             raise AttributeError("No users to retrieve because grid's DataFrame 'df' has not been set")
 
+    @property
+    def users(self):
+        """
+        The `UserIndex` carried by `df` (see `UserIndex.from_df`), built once
+        per DataFrame.
+        """
+        if self.df is None:
+            raise AttributeError("No users to retrieve because grid's DataFrame 'df' has not been set")
+        cached = getattr(self, "_users", None)
+        if cached is None or cached[0] is not self.df:
+            self._users = (self.df, UserIndex.from_df(self.df))
+        return self._users[1]
+
+# ------------------------------------------------------------------------------
+
+class GridPyramid(object):
+    """
+    Stack of grids with gridsizes `gridsize * 2**k`, all derived from a
+    single populated base grid at the finest resolution.
+
+    Coarser levels are built on first access by merging the cells of the
+    base grid, without recomputing the location of any point. Each level is
+    a regular `Grid` (or `TimeGrid`, keeping the time axis of the base), so
+    `sizematrix`, `get_max_traffic_cell` and the rendezvous measures accept
+    any level.
+
+    Common instantiation::
+        GridPyramid.build(df, bbox=BBOX, gridsize=0.5)
+        GridPyramid(TimeGrid.build(df, bbox=BBOX, gridsize=0.5, tres=24))
+
+    Args:
+        base (Grid): Data-populated grid at the finest resolution.
+        levels (int, optional): Maximum number of levels, including the base.
+            Levels stop anyway once the cells no longer fit within the bbox.
+    """
+    def __init__(self, base, levels=None):
+        if base.df is None or "icell" not in base.df:
+            raise ValueError("The base grid must be populated (see 'Grid.build')")
+        self.base = base
+        nlevels = 1
+        while min(base.size) >= base.gridsize * 2 ** nlevels:
+            nlevels += 1
+        self.nlevels = nlevels if levels is None else min(nlevels, levels)
+        self._levels = {0: base}
+
+    def __repr__(self):
+        return "GridPyramid(gridsizes=%s)" % self.gridsizes
+
+    def __len__(self):
+        return self.nlevels
+
+    def __getitem__(self, k):
+        return self.level(k)
+
+    def __iter__(self):
+        return (self.level(k) for k in range(self.nlevels))
+
+    def level(self, k):
+        """Return the grid of gridsize `base.gridsize * 2**k`."""
+        if k < 0:
+            k += self.nlevels
+        if not 0 <= k < self.nlevels:
+            raise IndexError("Level %s out of range [0, %s)" % (k, self.nlevels))
+        if k not in self._levels:
+            self._levels[k] = self._aggregate(k)
+        return self._levels[k]
+
+    def level_for(self, gridsize):
+        """Return the level whose gridsize is closest to `gridsize`."""
+        k = int(round(np.log2(float(gridsize) / self.base.gridsize)))
+        return self.level(min(max(k, 0), self.nlevels - 1))
+
+    def _aggregate(self, k):
+        base = self.base
+        g = base._resized(base.gridsize * 2 ** k)
+        rows0, rows = base.rowlength, g.rowlength
+
+        # rows are indexed from the north, so merge cells counting from the
+        # south (row index is always the second to last)
+        def coarse(cell):
+            i, j = cell[-2:]
+            return cell[:-2] + (rows - 1 - ((rows0 - 1 - i) >> k), j >> k)
+
+        keymap = {}
+        for cell in base.data:
+            keymap[cell] = coarse(cell)
+            g.data.extend(keymap[cell], base.data.elements[cell])
+
+        df = base.df.copy()
+        icell = np.empty(len(df), dtype=object)
+        icell[:] = [keymap[c] for c in base.df["icell"]]
+        df["icell"] = icell
+        g.df = df
+        return g
+
+    # -- CLASS METHODS --
+    @classmethod
+    def build(cls, df, gridclass=None, levels=None, **kwargs):
+        """
+        Build the base grid with `gridclass.build(df, **kwargs)` (a `Grid` by
+        default) and return the pyramid on top of it.
+        """
+        gridclass = gridclass or Grid
+        return cls(gridclass.build(df, **kwargs), levels=levels)
+
+    # -- PROPERTIES --
+    @property
+    def gridsizes(self):
+        return [self.base.gridsize * 2 ** k for k in range(self.nlevels)]
+
+# ------------------------------------------------------------------------------
+
+class QuadGrid(Grid):
+    """
+    Adaptive grid whose cells are recursively split into four quadrants once
+    they hold more than `capacity` points.
+
+    Points are stored in the leaves of one quadtree per cell of the regular
+    grid of size `gridsize`. Leaves are indexed by `(level, i, j)`, where
+    (i, j) is the cell index (rows counted from the north, as in `Grid`) in
+    the regular grid of size `gridsize / 2**level`. The children of leaf
+    (l, i, j) are (l + 1, 2i + di, 2j + dj) for di, dj in [0, 1].
+
+    Common instantiation::
+        QuadGrid.build(df, bbox, gridsize, capacity)
+
+    Args:
+        bbox (list, optional): Bounding box in degrees of the format
+            [W, S, E, N].
+        gridsize (float): The spatial resolution of the top-level cells in
+            kilometers.
+        capacity (int, optional): Maximum number of points per leaf. It is
+            only exceeded by leaves at depth `max_depth`, e.g. by many reports
+            from the very same location.
+        max_depth (int, optional): Maximum number of subdivisions of a cell.
+        df (pandas.DataFrame, optional): Source pandas.DataFrame.
+        lazy (int, optional): The degree of laziness in distance calculations.
+    """
+    def __init__(self, bbox=None, gridsize=None, capacity=64, max_depth=8, df=None, lazy=0):
+        super(QuadGrid, self).__init__(bbox, df=df, gridsize=gridsize, lazy=lazy)
+        if capacity < 1:
+            raise ValueError("'capacity' must be positive")
+        self.capacity = capacity
+        self.max_depth = max_depth
+        self.leaves = {} # leaf index -> list of (north offset, east offset, point)
+        self._split = set() # indices of subdivided nodes
+
+    def __repr__(self):
+        return "QuadGrid(%s, %s leaves, max. %s points per leaf)" % (self.shape, len(self.leaves), self.max_occupancy)
+
+    def __getitem__(self, cellindex):
+        if isinstance(cellindex, (list, tuple)) and len(cellindex) in [2, 3]:
+            return self.get_points(cellindex)
+        else:
+            raise TypeError("Invalid argument type")
+
+    def _child(self, node, dn, de):
+        level, i, j = node
+        size = self.gridsize / 2 ** (level + 1)
+        # rows grow southwards, so the lower half gets the odd row
+        di = 1 - int(dn / size) % 2
+        dj = int(de / size) % 2
+        return (level + 1, 2 * i + di, 2 * j + dj)
+
+    def _locate(self, dn, de):
+        node = (0, self.rowlength - int(dn / self.gridsize) - 1, int(de / self.gridsize))
+        while node in self._split:
+            node = self._child(node, dn, de)
+        return node
+
+    def _subdivide(self, leaf):
+        entries = self.leaves[leaf]
+        while len(entries) > self.capacity and leaf[0] < self.max_depth:
+            del self.leaves[leaf]
+            self._split.add(leaf)
+            for entry in entries:
+                self.leaves.setdefault(self._child(leaf, *entry[:2]), []).append(entry)
+            # continue with the fullest child
+            leaf = max((self._child(leaf, *e[:2]) for e in entries), key=lambda c: len(self.leaves[c]))
+            entries = self.leaves[leaf]
+
+    def add_point(self, *args, **kwargs):
+        if len(args) == 2:
+            lat, lng = args
+            P = Point((lat, lng), metadata=kwargs)
+        elif len(args) == 1 and isinstance(args[0], Point):
+            P = args[0]
+        else:
+            raise TypeError("Invalid point type")
+        if not in_bounds(P, self.bbox):
+            raise ValueError("Point (%s, %s) not inside grid's bbox" % (P.lat, P.lng))
+        return self._insert(P, *self._offsets(P))
+
+    def _insert(self, P, dn, de):
+        """Insert `P`, at the offsets (dn, de) (see `_offsets`), into its leaf."""
+        leaf = self._locate(dn, de)
+        self.leaves.setdefault(leaf, []).append((dn, de, P))
+        if len(self.leaves[leaf]) > self.capacity:
+            self._subdivide(leaf)
+            leaf = self._locate(dn, de)
+        self._sat = None
+        return leaf
+
+    def get_leaf(self, lat, lng):
+        """Return the index of the leaf containing the location (lat, lng)."""
+        return self._locate(*self._offsets(Point((lat, lng))))
+
+    def get_cells(self, uid):
+        cells = super(QuadGrid, self).get_cells(uid)
+        if any(c in self._split for c in cells): # split after 'build'
+            rows = self.df.loc[[uid]]
+            cells = list(set(self.get_leaf(lat, lng) for lat, lng in zip(rows.lat, rows.lng)))
+        return cells
+
+    def get_points(self, cellindex):
+        """
+        Return the points in the leaf `cellindex`. An index of an inner node,
+        or a pair (i, j) for a top-level cell, returns all the points below.
+        """
+        if len(cellindex) == 2:
+            cellindex = (0,) + tuple(cellindex)
+        if cellindex in self.leaves:
+            return [P for dn, de, P in self.leaves[cellindex]]
+        elif cellindex in self._split:
+            level, i, j = cellindex
+            return [P for child in product([0, 1], repeat=2)
+                for P in self.get_points((level + 1, 2 * i + child[0], 2 * j + child[1]))]
+        else:
+            return []
+
+    # -- CLASS METHODS --
+    @classmethod
+    def build(cls, df, bbox=None, gridsize=1.0, capacity=64, max_depth=8, lazy=0, sindex=None):
+        """
+        Build an adaptive grid from the locations of each point of the
+        DataFrame `df`. The 'icell' column of the grid's DataFrame holds the
+        leaf index of each report.
+
+        Runtime:
+            O(S * D), where S is the size of `df` and D the depth of the
+            quadtrees.
+        """
+        g = cls(bbox, gridsize=gridsize, capacity=capacity, max_depth=max_depth, lazy=lazy)
+        df_bounded = bound(df, bbox, sindex).reset_index()
+        offsets = []
+        for _, row in df_bounded.iterrows():
+            P = Point((row.lat, row.lng), metadata=row_metadata(row))
+            offsets.append(g._offsets(P)) # bounded, see `add_point`
+            g._insert(P, *offsets[-1])
+        # assign leaves once all the cells have been split
+        icell = np.empty(len(df_bounded), dtype=object)
+        icell[:] = [g._locate(dn, de) for dn, de in offsets]
+        df_bounded["icell"] = icell
+        df_bounded.set_index("user_id", inplace=True)
+        df_bounded.index.name = "user_id"
+        g.df = df_bounded
+        return g
+
+    # -- PROPERTIES --
+    @property
+    def sizematrix(self):
+        """Number of points in each top-level cell."""
+        m = np.matrix(np.zeros(self.shape, dtype=np.int))
+        for (level, i, j), entries in self.leaves.items():
+            m[i >> level, j >> level] += len(entries)
+        return m
+
+    @property
+    def leafsizes(self):
+        """Dictionary giving the number of points in each leaf."""
+        return dict((leaf, len(entries)) for leaf, entries in self.leaves.items())
+
+    @property
+    def max_occupancy(self):
+        return max([len(entries) for entries in self.leaves.values()] or [0])
+
+    @property
+    def depth(self):
+        return max([leaf[0] for leaf in self.leaves] or [0])
+
 # ------------------------------------------------------------------------------
 # Main functions
 
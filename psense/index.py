@@ -0,0 +1,372 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------------------
+# Created: 18 Oct. 2026
+# ------------------------------------------------------------------------------
+# Static indices over the report DataFrame. All query results are positional
+# row indices into the indexed frame, in ascending order, so that
+# `df.iloc[result]` keeps the original row ordering of `df`.
+# ------------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+
+from psense.util import haversine, EARTH_RADIUS
+
+# ------------------------------------------------------------------------------
+
+def to_ns(t):
+    """Convert a timestamp (or an array of timestamps) to int64 nanoseconds."""
+    if isinstance(t, (np.ndarray, pd.Series, pd.Index)):
+        return np.asarray(t, dtype='datetime64[ns]').view(np.int64)
+    return pd.Timestamp(t).value
+
+# ------------------------------------------------------------------------------
+
+class SpatialIndex(object):
+    """
+    Static KD-tree over the (lat, lng) coordinates of a DataFrame.
+
+    Common instantiation::
+        SpatialIndex(df)
+
+    Args:
+        df (pandas.DataFrame): Source dataframe with 'lat' and 'lng' columns.
+            The index must be rebuilt if the rows of `df` change.
+        leafsize (int, optional): Maximum number of points per leaf.
+
+    Runtime:
+        O(S * log(S)) to build, where S is the size of `df`. Box and radius
+        queries take O(log(S) + k) on average, where k is the number of
+        reported points.
+    """
+    def __init__(self, df, leafsize=32):
+        if leafsize < 1:
+            raise ValueError("'leafsize' must be positive")
+        self.lat = np.asarray(df['lat'], dtype=np.float64)
+        self.lng = np.asarray(df['lng'], dtype=np.float64)
+        self.leafsize = leafsize
+        self._build()
+
+    def __len__(self):
+        return len(self.lat)
+
+    def __repr__(self):
+        return "SpatialIndex(%s points, %s nodes)" % (len(self), len(self._lo))
+
+    def _build(self):
+        coords = (self.lat, self.lng)
+        perm = np.arange(len(self), dtype=np.intp)
+        lo, hi, left, right, axes, splits, bounds = [], [], [], [], [], [], []
+
+        def new_node(a, b):
+            lo.append(a)
+            hi.append(b)
+            left.append(-1)
+            right.append(-1)
+            axes.append(-1)
+            splits.append(np.nan)
+            if b > a:
+                idx = perm[a:b]
+                bounds.append((self.lat[idx].min(), self.lng[idx].min(),
+                    self.lat[idx].max(), self.lng[idx].max()))
+            else: # empty node is disjoint from every box
+                bounds.append((np.inf, np.inf, -np.inf, -np.inf))
+            return len(lo) - 1
+
+        stack = [new_node(0, len(self))]
+        while stack:
+            node = stack.pop()
+            a, b = lo[node], hi[node]
+            if b - a <= self.leafsize:
+                continue
+            # split along the axis with the largest spread
+            S, W, N, E = bounds[node]
+            axis = 0 if (N - S) >= (E - W) else 1
+            mid = (a + b) // 2
+            sub = perm[a:b]
+            part = np.argpartition(coords[axis][sub], mid - a)
+            perm[a:b] = sub[part]
+            axes[node] = axis
+            splits[node] = coords[axis][perm[mid]]
+            left[node] = new_node(a, mid)
+            right[node] = new_node(mid, b)
+            stack.extend([left[node], right[node]])
+
+        self._perm = perm
+        self._lo = np.array(lo, dtype=np.intp)
+        self._hi = np.array(hi, dtype=np.intp)
+        self._left = np.array(left, dtype=np.intp)
+        self._right = np.array(right, dtype=np.intp)
+        self._axis = np.array(axes, dtype=np.int8)
+        self._split = np.array(splits, dtype=np.float64)
+        self._bounds = np.array(bounds, dtype=np.float64).reshape(-1, 4)
+
+    def _query_bbox(self, bbox):
+        """Return the list of index arrays covering the points in `bbox`."""
+        W, S, E, N = bbox
+        found = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            nS, nW, nN, nE = self._bounds[node]
+            if nS >= N or nN < S or nW >= E or nE < W: # disjoint
+                continue
+            a, b = self._lo[node], self._hi[node]
+            if nS >= S and nN < N and nW >= W and nE < E: # contained
+                found.append(self._perm[a:b])
+            elif self._left[node] < 0: # partially covered leaf
+                idx = self._perm[a:b]
+                lat, lng = self.lat[idx], self.lng[idx]
+                found.append(idx[(lng >= W) & (lng < E) & (lat >= S) & (lat < N)])
+            else:
+                stack.extend([self._left[node], self._right[node]])
+        return found
+
+    def query_bbox(self, bbox):
+        """
+        Return the row positions of the points inside `bbox` = [W, S, E, N],
+        following the half-open convention of `psense.util.bound`.
+        """
+        found = self._query_bbox(bbox)
+        if not found:
+            return np.empty(0, dtype=np.intp)
+        return np.sort(np.concatenate(found))
+
+    def count_bbox(self, bbox):
+        """Return the number of points inside `bbox` = [W, S, E, N]."""
+        return sum(len(idx) for idx in self._query_bbox(bbox))
+
+    def query_radius(self, P, r, return_distance=False):
+        """
+        Return the row positions of the points within `r` km (great-circle)
+        of the point `P` = (lat, lng).
+        """
+        lat, lng = P
+        # smallest box in degrees enclosing the spherical cap
+        a = float(r) / EARTH_RADIUS
+        dlat = np.degrees(a)
+        s = np.sin(min(a, np.pi / 2)) / max(np.cos(np.radians(lat)), 1e-12)
+        dlng = np.degrees(np.arcsin(s)) if s < 1 else 180.0
+        pad = 1e-9
+        idx = self.query_bbox([lng - dlng - pad, lat - dlat - pad, lng + dlng + pad, lat + dlat + pad])
+        d = haversine(lat, lng, self.lat[idx], self.lng[idx])
+        mask = d <= r
+        if return_distance:
+            return idx[mask], d[mask]
+        return idx[mask]
+
+    def query_knn(self, P, k=1):
+        """
+        Return the row positions and distances (in km) of the `k` points
+        nearest to `P` = (lat, lng), sorted by distance.
+        """
+        if k < 1:
+            raise ValueError("'k' must be positive")
+        if k >= len(self):
+            idx = np.arange(len(self), dtype=np.intp)
+            d = haversine(P[0], P[1], self.lat, self.lng)
+        else:
+            # descend to the smallest node around P still holding k points;
+            # its k-th nearest point bounds the search radius
+            node = 0
+            while self._left[node] >= 0:
+                child = self._left[node] if P[self._axis[node]] < self._split[node] \
+                    else self._right[node]
+                if self._hi[child] - self._lo[child] < k:
+                    break
+                node = child
+            cand = self._perm[self._lo[node]:self._hi[node]]
+            dc = haversine(P[0], P[1], self.lat[cand], self.lng[cand])
+            r = np.partition(dc, k - 1)[k - 1]
+            idx, d = self.query_radius(P, r, return_distance=True)
+        order = np.argsort(d, kind='mergesort')[:k]
+        return idx[order], d[order]
+
+    # -- PROPERTIES --
+    @property
+    def bbox(self):
+        """Bounding box [W, S, E, N] of the indexed points (see `get_bbox`)."""
+        S, W, N, E = self._bounds[0]
+        return [W, S, E + 1e-15, N + 1e-15]
+
+# ------------------------------------------------------------------------------
+
+class TimeIndex(object):
+    """
+    Sorted int64 (nanoseconds) copy of the 'created_at' column of a
+    DataFrame, answering time-range queries by binary search.
+
+    Common instantiation::
+        TimeIndex(df)
+
+    Args:
+        df (pandas.DataFrame): Source dataframe with a 'created_at' column.
+            The index must be rebuilt if the rows of `df` change.
+
+    Runtime:
+        O(S * log(S)) to build, where S is the size of `df`. Range queries
+        take O(log(S) + k), where k is the number of reported rows.
+    """
+    def __init__(self, df):
+        ts = to_ns(df['created_at'])
+        self._order = np.argsort(ts, kind='mergesort')
+        self.ts = ts[self._order]
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __repr__(self):
+        return "TimeIndex(%s timestamps)" % len(self)
+
+    def _range(self, timespan):
+        begin, end = timespan
+        a = np.searchsorted(self.ts, to_ns(begin), side='left')
+        b = np.searchsorted(self.ts, to_ns(end), side='left')
+        return a, max(a, b)
+
+    def query(self, timespan):
+        """
+        Return the row positions of the reports with
+        begin <= created_at < end, where `timespan` = (begin, end).
+        """
+        a, b = self._range(timespan)
+        return np.sort(self._order[a:b])
+
+    def count(self, timespan):
+        """Return the number of reports inside `timespan` = (begin, end)."""
+        a, b = self._range(timespan)
+        return b - a
+
+    # -- PROPERTIES --
+    @property
+    def timespan(self):
+        """Time span (begin, end) of the indexed reports (see `get_timespan`)."""
+        begin = pd.Timestamp(int(self.ts[0]))
+        end = pd.Timestamp(int(self.ts[-1])) + pd.Timedelta(microseconds=1)
+        return (begin, end)
+
+# ------------------------------------------------------------------------------
+
+def user_numbers(df):
+    """
+    The 'user_num' column of `df` (see `UserIndex.annotate`) as int64, which
+    must hold non-negative integers, e.g. not the NaN of rows added without
+    user number.
+    """
+    nums = np.asarray(df["user_num"])
+    if nums.dtype.kind in "iu":
+        ints = nums.astype(np.int64)
+    elif nums.dtype.kind == "f" and np.isfinite(nums).all() and (nums == np.floor(nums)).all():
+        ints = nums.astype(np.int64)
+    else:
+        ints = None
+    if ints is None or (ints < 0).any():
+        raise ValueError("The 'user_num' column must hold non-negative integers")
+    return ints
+
+class _Gap(object):
+    """
+    Placeholder of a user number without user, see `UserIndex.from_df`.
+    Placeholders are all distinct, so that interning keeps every one.
+    """
+    __slots__ = ()
+
+class UserIndex(object):
+    """
+    Interned mapping between external user IDs (strings or integers) and
+    dense int32 user numbers 0, 1, ..., so that per-user structures can be
+    flat arrays indexed by user number. The mapping only grows: adding IDs
+    never renumbers the known users.
+
+    Frames carry the mapping in a 'user_num' column (see `annotate`), which
+    the grid builders copy to `Grid.df` and to the point metadata, and
+    `do_stats` to its output.
+
+    Common instantiation::
+        users = UserIndex.from_df(df)
+        df = users.annotate(df)
+
+    Args:
+        ids (iterable, optional): Initial user IDs, numbered in order.
+    """
+    def __init__(self, ids=()):
+        self._index = pd.Index([])
+        self.add(ids)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, uid):
+        return uid in self._index
+
+    def __repr__(self):
+        return "UserIndex(%s users)" % len(self)
+
+    def add(self, ids):
+        """Intern the new IDs among `ids` and return the numbers of all of them."""
+        ids = pd.Index(ids).unique()
+        if not len(self._index):
+            self._index = pd.Index(ids)
+        else:
+            new = ids[self._index.get_indexer(ids) < 0]
+            if len(new):
+                self._index = self._index.append(pd.Index(new))
+        return self.encode(ids)
+
+    def encode(self, ids):
+        """User numbers of the known IDs `ids`."""
+        ids = pd.Index(ids)
+        codes = self._index.get_indexer(ids)
+        if (codes < 0).any():
+            raise ValueError("Unknown user IDs: %s" % list(ids[codes < 0][:5]))
+        return codes.astype(np.int32)
+
+    def decode(self, codes):
+        """User IDs of the user numbers `codes`."""
+        return self.ids[np.asarray(codes)]
+
+    def annotate(self, df, level="user_id"):
+        """
+        Return `df` with a 'user_num' column, placed first so that it is part
+        of the point metadata. New users are added to the mapping.
+        """
+        codes = pd.factorize(df.index.get_level_values(level))
+        nums = self.add(codes[1])[codes[0]]
+        df = df.drop("user_num", axis=1) if "user_num" in df else df.copy()
+        df.insert(0, "user_num", nums)
+        return df
+
+    # -- CLASS METHODS --
+    @classmethod
+    def from_df(cls, df, level="user_id"):
+        """
+        Mapping of the users of `df`: the one carried by its 'user_num'
+        column if any, else a new one numbering the sorted IDs. The numbers
+        of users without reports in `df` (e.g. after `bound`) map to None.
+        """
+        ids = np.asarray(df.index.get_level_values(level))
+        if "user_num" not in df:
+            return cls(np.sort(pd.unique(ids)))
+        nums, first, inverse = np.unique(user_numbers(df), return_index=True, return_inverse=True)
+        if (ids != ids[first][inverse]).any():
+            raise ValueError("The 'user_num' column maps a user number to several IDs")
+        if len(nums) and nums[-1] != len(nums) - 1: # gaps
+            table = np.array([_Gap() for _ in range(nums[-1] + 1)], dtype=object)
+            table[nums] = ids[first]
+            return cls(table)
+        return cls(ids[first])
+
+    # -- PROPERTIES --
+    @property
+    def ids(self):
+        """User IDs, by user number (None for the gaps of `from_df`)."""
+        ids = np.asarray(self._index)
+        if ids.dtype == object:
+            gaps = np.array([isinstance(i, _Gap) for i in ids], dtype=bool)
+            if gaps.any():
+                ids = ids.copy()
+                ids[gaps] = None
+        return ids
+
+# ------------------------------------------------------------------------------
@@ -5,17 +5,157 @@
 # Created: 5 Dec. 2014
 #-------------------------------------------------------------------------------
 
-from os import listdir
+import sys
+from os import listdir, makedirs, remove, rename, stat
 from os.path import abspath, join, splitext, isfile, isdir, dirname, getmtime, getsize, basename
+from hashlib import md5
 import random as rdm
+from multiprocessing.pool import ThreadPool
 
+import numpy as np
 import pandas as pd
 
+from psense.util import rechunk
 from psense.stats import *
+from psense.trajectory import simplify_mask
+from psense.store import compact as compact_df
+from psense.geojson import write_paths, write_points
 
 #-------------------------------------------------------------------------------
 
-def choose_files(dirpath, filenumber=None, size=[], newest=True, random=False):
+MANIFEST_NAME = ".psense-manifest.npz"
+
+class Manifest(object):
+    """
+    Persistent listing of the CSV files of a directory, with the size,
+    modification time and row count of each file, kept in `path` (by
+    default a hidden file inside the directory).
+
+    `update` only lists the directory if its modification time or size
+    changed, i.e. if files were added or removed, and only stats and counts
+    the new files; `full=True` re-stats every file to catch files modified
+    in place.
+
+    Common instantiation::
+        Manifest(dirpath).update().select(100, newest=True)
+
+    Args:
+        dirpath (str): The directory of CSV files.
+        path (str, optional): Path of the manifest file.
+    """
+    def __init__(self, dirpath, path=None):
+        self.dirpath = abspath(dirpath)
+        self.path = path or join(self.dirpath, MANIFEST_NAME)
+        self.dir_mtime = None
+        self.dir_size = None
+        self.names = np.array([], dtype=str)
+        self.sizes = np.array([], dtype=np.int64)
+        self.mtimes = np.array([], dtype=np.float64)
+        self.rows = np.array([], dtype=np.int64)
+        if isfile(self.path):
+            self.load()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return "Manifest(%s, %s files)" % (self.dirpath, len(self))
+
+    def load(self):
+        data = np.load(self.path)
+        try:
+            self.dir_mtime = float(data["dir_mtime"])
+            self.dir_size = int(data["dir_size"]) if "dir_size" in data else None
+            self.names, self.sizes = data["names"], data["sizes"]
+            self.mtimes, self.rows = data["mtimes"], data["rows"]
+        finally:
+            data.close()
+        return self
+
+    def save(self):
+        # written in place: renaming would change the directory's mtime
+        with open(self.path, "wb") as f:
+            np.savez(f, dir_mtime=self.dir_mtime, dir_size=self.dir_size, names=self.names,
+                sizes=self.sizes, mtimes=self.mtimes, rows=self.rows)
+        return self
+
+    def dir_state(self):
+        """Modification time and size of the directory."""
+        s = stat(self.dirpath)
+        return (s.st_mtime, s.st_size)
+
+    def update(self, full=False):
+        """
+        Bring the manifest up to date with the directory and save it.
+
+        Runtime: O(1) if the directory did not change. Otherwise O(N) to list
+            it, plus reading the new files (or all of them if `full`).
+        """
+        state = self.dir_state()
+        if state == (self.dir_mtime, self.dir_size) and not full:
+            return self
+        names = sorted(f for f in listdir(self.dirpath) if splitext(f)[1] == '.csv')
+        known = dict((n, i) for i, n in enumerate(self.names))
+        sizes, mtimes, rows, kept = [], [], [], []
+        for name in names:
+            filepath = join(self.dirpath, name)
+            i = known.get(name)
+            if i is not None and not full:
+                st = (self.sizes[i], self.mtimes[i])
+            else:
+                if not isfile(filepath):
+                    continue
+                s = stat(filepath)
+                st = (s.st_size, s.st_mtime)
+            kept.append(name)
+            sizes.append(st[0])
+            mtimes.append(st[1])
+            if i is not None and (self.sizes[i], self.mtimes[i]) == st:
+                rows.append(self.rows[i])
+            else:
+                rows.append(len(pd.read_csv(filepath, usecols=[0])))
+        self.names = np.array(kept, dtype=str)
+        self.sizes = np.array(sizes, dtype=np.int64)
+        self.mtimes = np.array(mtimes, dtype=np.float64)
+        self.rows = np.array(rows, dtype=np.int64)
+        self.dir_mtime, self.dir_size = state
+        created = not isfile(self.path)
+        self.save()
+        if created and self.dir_state() != state:
+            # creating the manifest inside the directory changed it
+            self.dir_mtime, self.dir_size = self.dir_state()
+            self.save()
+        return self
+
+    def select(self, filenumber=None, size=[], newest=True, random=False):
+        """Return the paths of the files chosen as in `choose_files`."""
+        if not len(self):
+            raise IOError("No CSV files within the specified directory: " + self.dirpath)
+        if not random:
+            order = np.argsort(-self.mtimes if newest else self.mtimes, kind='mergesort')
+        else:
+            order = np.random.permutation(len(self))
+        if size:
+            assert len(size) == 2
+            minsize, maxsize = size
+            sizes = self.sizes[order]
+            order = order[(sizes >= minsize) & (sizes < maxsize)]
+            if not len(order):
+                raise IOError("No CSV files matching the conditions: %sB <= file size < %sB" % (minsize, maxsize))
+        return [join(self.dirpath, n) for n in self.names[order[:filenumber]]]
+
+    # -- PROPERTIES --
+    @property
+    def files(self):
+        """The manifest as a DataFrame indexed by path."""
+        return pd.DataFrame({"size": self.sizes, "mtime": pd.to_datetime(self.mtimes, unit='s'),
+            "rows": self.rows}, index=pd.Index([join(self.dirpath, n) for n in self.names], name="path"),
+            columns=["size", "mtime", "rows"])
+
+def choose_files(dirpath, filenumber=None, size=[], newest=True, random=False, manifest=False):
+    if manifest:
+        return Manifest(dirpath).update().select(filenumber, size, newest, random)
+
     csv_files = [abspath(join(dirpath, f)) for f in listdir(dirpath) \
         if isfile(join(dirpath, f)) and splitext(f)[1] == '.csv']
 
@@ -37,45 +177,220 @@ def choose_files(dirpath, filenumber=None, size=[], newest=True, random=False):
 
     return csv_files[:filenumber]
 
-def build_df(csv_files):
+DTYPES = {"user_id": np.int64, "id": np.int64, "text": object,
+    "lng": np.float64, "lat": np.float64}
+CORE_COLUMNS = ["user_id", "created_at", "lng", "lat"]
+
+def read_csv(filepath, usecols=None, chunksize=None):
+    """
+    Read a single CSV file of reports with explicit dtypes, parsing
+    'created_at' at read time. Returns an iterator of DataFrames if
+    `chunksize` is given.
+    """
+    dtype = DTYPES if usecols is None else \
+        dict((c, t) for c, t in DTYPES.items() if c in usecols)
+    return pd.read_csv(filepath, usecols=usecols, dtype=dtype,
+        parse_dates=["created_at"], infer_datetime_format=True, chunksize=chunksize)
+
+def iter_chunks(csv_files, chunksize=100000, usecols=CORE_COLUMNS):
+    """
+    Generate the reports of the CSV files as DataFrames of `chunksize` rows,
+    indexed by 'user_id', without loading the whole corpus. The chunks can
+    be fed to `Grid.build_chunks`, `TimeGrid.build_chunks` or
+    `psense.stats.chunked_stats`.
+    """
+    csv_files = [csv_files] if isinstance(csv_files, str) else csv_files
+    def frames():
+        for filepath in csv_files:
+            for df in read_csv(filepath, usecols, chunksize):
+                yield df.set_index("user_id")
+    return rechunk(frames(), chunksize)
+
+def cache_path(filepath, cachedir):
+    """
+    Path of the cached columns of a CSV file, keyed by the file path plus its
+    modification time and size.
+    """
+    st = stat(filepath)
+    key = md5(abspath(filepath)).hexdigest()[:16]
+    stamp = md5("%r:%s" % (st.st_mtime, st.st_size)).hexdigest()[:16]
+    return join(cachedir, "%s-%s.npz" % (key, stamp))
+
+def read_cached(filepath, cachedir, usecols=None):
+    """
+    Read a CSV file through a columnar cache: the columns of the file are
+    stored as numpy arrays in `cachedir` on the first read, and loaded from
+    there (only those in `usecols`) as long as the file does not change.
+    Stale entries of a file are removed when it is cached again.
+    """
+    path = cache_path(filepath, cachedir)
+    if not isfile(path):
+        df = read_csv(filepath)
+        if not isdir(cachedir):
+            makedirs(cachedir)
+        key = basename(path).split("-")[0]
+        for f in listdir(cachedir):
+            if f.startswith(key + "-"):
+                remove(join(cachedir, f))
+        arrays = {}
+        for c in df.columns:
+            values = df[c].values
+            if values.dtype == object:
+                # fixed-width strings load much faster than pickled objects
+                null = pd.isnull(values)
+                values = np.where(null, "", values).astype(str)
+                if null.any():
+                    arrays[c + "__null__"] = null
+            arrays[c] = values
+        tmp = path[:-len(".npz")] + ".tmp.npz" # np.savez appends '.npz'
+        np.savez(tmp, __columns__=np.array(df.columns, dtype=str), **arrays)
+        rename(tmp, path)
+        return df if usecols is None else df[usecols]
+
+    data = np.load(path)
+    try:
+        columns = [c for c in data["__columns__"] if usecols is None or c in usecols]
+        arrays = {}
+        for c in columns:
+            values = data[c]
+            if values.dtype.kind in "SU":
+                values = values.astype(object)
+                if c + "__null__" in data.files:
+                    values[data[c + "__null__"]] = np.nan
+            arrays[c] = values
+        return pd.DataFrame(arrays, columns=columns)
+    finally:
+        data.close()
+
+def build_df(csv_files, usecols=None, workers=4, verbose=True, cache=None, compact=False, text_path=None, users=None):
     """
     Returns a sorted pandas.DataFrame object made up of all csv objects
     together.
 
     Expects a list if CSV paths with at least 'user_id', 'lat', 'lng' and 'created_at' entries.
+
+    Args:
+        csv_files (list or str): CSV paths.
+        usecols (list, optional): Columns to read, e.g. `CORE_COLUMNS` to
+            leave out the heavy 'text' column. All columns by default.
+        workers (int, optional): Number of threads reading the files.
+        verbose (bool, optional): Print a progress counter.
+        cache (str, optional): Directory of a columnar cache of the files
+            (see `read_cached`).
+        compact (bool, optional): Shrink the frame with
+            `psense.store.compact`, moving the texts to a `TextStore` at
+            `text_path` if given.
+        users (psense.index.UserIndex, optional): Mapping in which to intern
+            the user IDs, added to the frame as a 'user_num' column.
     """
-    df_list = []
     csv_files = [csv_files] if isinstance(csv_files, str) else csv_files
+    if cache:
+        read = lambda f: read_cached(f, cache, usecols)
+    else:
+        read = lambda f: read_csv(f, usecols)
 
-    print "Processing..."
-    for filepath in csv_files:
-        print "\rLoading file \"%s\"" % basename(filepath)
-        df = pd.read_csv(filepath)
-        df.set_index("user_id", inplace=True)
-        df.index.name = "user_id"
-        df_list.append(df)
-
-    df = pd.concat(df_list) # merge list info one DF
-    df.sort(inplace=True)
-    df['created_at'] = pd.to_datetime(df['created_at'])
+    df_list = []
+    pool = ThreadPool(max(1, min(workers or 1, len(csv_files))))
+    try:
+        # imap keeps the order of the files, so the final sort is deterministic
+        for i, df in enumerate(pool.imap(read, csv_files)):
+            df_list.append(df)
+            if verbose:
+                sys.stdout.write("\rLoading files: %s/%s" % (i + 1, len(csv_files)))
+                sys.stdout.flush()
+    finally:
+        pool.close()
+    if verbose:
+        sys.stdout.write("\n")
+
+    df = pd.concat(df_list, ignore_index=True) # merge list info one DF
+    df.set_index("user_id", inplace=True)
+    df.sort_index(inplace=True, kind='mergesort')
+    if users is not None:
+        df = users.annotate(df)
+    if compact:
+        df = compact_df(df, text_path, verbose)
     return df
 
 #-------------------------------------------------------------------------------
 
 def write_geojson(df, outpath, toPoints=False):
-    geojson = '{"type":"FeatureCollection","features":['
-
-    for i, (uid, fr) in enumerate(df.groupby(level="user_id")):
-        geomType = "MultiPoint" if toPoints else "LineString"
-        geojson += '{"type":"Feature","properties":{"number":%s,"id":%s},"geometry":{"type":"%s","coordinates":[' % (i, uid, geomType)
-        for i, r in fr.iterrows():
-            c = "[%s,%s]," % (r["lng"], r["lat"]) # geojson [lng, lat] standard  layout
-            geojson += c
-        geojson = geojson[:-1] + "]}}," # remove trailing comma of last coord.
-    geojson = geojson[:-1] + "]}" # remove trailing comma of last path
+    """
+    Write the path (or the points) of each user as a GeoJSON feature, one
+    user at a time.
+    """
+    uids, starts, order = group_users(df)
+    lat = np.asarray(df["lat"], dtype=np.float64)[order]
+    lng = np.asarray(df["lng"], dtype=np.float64)[order]
+    write_paths(outpath, uids, lat, lng, starts, "MultiPoint" if toPoints else "LineString")
 
-    with open(outpath, "wt") as fout:
-        fout.write(geojson.encode('utf-8'))
+def export(df, lines=None, points=None, means=None, medians=None, stats=None,
+    tolerance=None, workers=None, threads=None, anchors=False):
+    """
+    Write several outputs of the same reports in one pass: the users are
+    grouped once, the centers computed once (the stats reuse them), and the
+    files written by `threads` threads if given.
+
+    Args:
+        lines, points, means, medians (str, optional): GeoJSON output paths
+            of `write_geojson` (lines or points) and `write_geojson_centers`
+            (geometric averages or medians).
+        stats (str or bool, optional): Path of the CSV of `do_stats`, or
+            True to only return the table.
+        tolerance (float, optional): Simplify the lines, see
+            `psense.trajectory.simplify`.
+        workers (int, optional): Number of processes computing the medians.
+        threads (int, optional): Number of threads writing the files.
+        anchors (bool, optional): Add the anchors to the stats.
+
+    Returns:
+        The stats table if `stats` is given, else None.
+    """
+    groups = uids, starts, order = group_users(df)
+    lat = np.asarray(df["lat"], dtype=np.float64)[order]
+    lng = np.asarray(df["lng"], dtype=np.float64)[order]
+    tasks = []
+
+    if lines:
+        llat, llng, lstarts = lat, lng, starts
+        if tolerance:
+            keep = simplify_mask(lat, lng, starts, tolerance)
+            llat, llng = lat[keep], lng[keep]
+            lstarts = np.concatenate(([0], np.cumsum(keep)))[starts]
+            print "Simplification removed %s of %s points (tolerance: %sm)" \
+                % (len(lat) - len(llat), len(lat), tolerance)
+        tasks.append(lambda: write_paths(lines, uids, llat, llng, lstarts))
+    if points:
+        tasks.append(lambda: write_paths(points, uids, lat, lng, starts, "MultiPoint"))
+
+    if means or stats:
+        alat, alng = geom_averages(lat, lng, starts)
+    if medians or stats:
+        mlat, mlng = merge_chunks(map_users(user_centers, lat, lng, starts, (geom_median,), workers))
+    if means:
+        tasks.append(lambda: write_points(means, uids, alat, alng))
+    if medians:
+        tasks.append(lambda: write_points(medians, uids, mlat, mlng))
+
+    stats_df = None
+    if stats:
+        stats_df = do_stats(df, anchors=anchors, groups=groups, centers=(alat, alng, mlat, mlng))
+        if isinstance(stats, str):
+            def write_stats():
+                with open(stats, 'wt') as f:
+                    stats_df.to_csv(f)
+            tasks.append(write_stats)
+
+    if threads and threads > 1 and len(tasks) > 1:
+        pool = ThreadPool(min(threads, len(tasks)))
+        try:
+            pool.map(lambda task: task(), tasks)
+        finally:
+            pool.close()
+    else:
+        for task in tasks:
+            task()
+    return stats_df
 
 #-------------------------------------------------------------------------------
 
@@ -114,6 +429,31 @@ if __name__ == '__main__':
         action="store_true",
         default=True,
         help="write as collection of lines (default if -p not present).")
+    parser.add_option("-t", "--tolerance",
+        dest="tolerance",
+        type="float",
+        default=None,
+        help="simplify the lines with a tolerance of TOLERANCE metres.")
+    parser.add_option("--cache",
+        dest="cache",
+        type="string",
+        default=None,
+        help="cache the parsed CSV files in the directory CACHE.")
+    parser.add_option("--compact",
+        dest="compact",
+        action="store_true",
+        default=False,
+        help="use compact dtypes (categorical user IDs, float32 coordinates).")
+    parser.add_option("--threads",
+        dest="threads",
+        type="int",
+        default=None,
+        help="number of threads writing the output files.")
+    parser.add_option("-m", "--manifest",
+        dest="manifest",
+        action="store_true",
+        default=False,
+        help="choose the files from a manifest of the directory, updated incrementally.")
     parser.add_option("-c", "--config",
         dest="configfile",
         type="string",
@@ -123,6 +463,16 @@ if __name__ == '__main__':
         action="callback",
         callback=stats_callback,
         help="print out the stats (with no arguments) or write the stats to STATSFILE.")
+    parser.add_option("-a", "--anchors",
+        dest="anchors",
+        action="store_true",
+        default=False,
+        help="add the home and work locations of each user to the stats.")
+    parser.add_option("-j", "--workers",
+        dest="workers",
+        type="int",
+        default=None,
+        help="number of processes computing the per-user centers and stats, and of threads reading the files.")
 
     (options, args) = parser.parse_args()
 
@@ -162,7 +512,7 @@ if __name__ == '__main__':
         # input path
         if isdir(args[0]):
             dirpath = args[0]
-            csv_files = choose_files(dirpath, options.nfiles, **extraparams)
+            csv_files = choose_files(dirpath, options.nfiles, manifest=options.manifest, **extraparams)
         elif all([isfile(a) for a in args]) \
             and all([a.endswith('.csv') for a in args]):
             csv_files = [abspath(f) for f in args]
@@ -170,39 +520,41 @@ if __name__ == '__main__':
             raise IOError("Files must be in CSV format")
 
         # build dataframe
-        df = build_df(csv_files)
+        df = build_df(csv_files, usecols=CORE_COLUMNS, workers=options.workers or 4,
+            cache=options.cache, compact=options.compact)
 
         if (options.toPoints or options.toLines) and not options.filename:
             parser.error("Output path not given")
 
-        # output
+        # output: all files in a single pass over the users
+        outputs = {}
         if options.filename:
-            outpaths = []
             if options.toPoints:
                 fname = options.filename
                 if options.toLines:
                     fname = fname[:fname.find(".geojson")] + "-pts.geojson"
-                    write_geojson(df, options.filename)
-                    outpaths.append(abspath(options.filename))
-                write_geojson(df, fname, toPoints=True)
-                outpaths.append(abspath(fname))
+                    outputs["lines"] = options.filename
+                outputs["points"] = fname
             else:
-                write_geojson(df, options.filename)
-                outpaths.append(abspath(options.filename))
-            print_success("Data written to:\n    " + "\n    ".join(outpaths))
-
+                outputs["lines"] = options.filename
         if hasattr(options, 'fmeans'):
-            write_geojson_centers(df, geom_average, options.fmeans)
-            print_success("Geometric means written to: " + options.fmeans)
+            outputs["means"] = options.fmeans
         if hasattr(options, 'fmedians'):
-            write_geojson_centers(df, geom_median, options.fmedians)
+            outputs["medians"] = options.fmedians
+
+        stats = export(df, stats=options.statsfile, tolerance=options.tolerance,
+            workers=options.workers, threads=options.threads, anchors=options.anchors, **outputs)
+
+        outpaths = [abspath(outputs[k]) for k in ["lines", "points"] if k in outputs]
+        if outpaths:
+            print_success("Data written to:\n    " + "\n    ".join(outpaths))
+        if "means" in outputs:
+            print_success("Geometric means written to: " + options.fmeans)
+        if "medians" in outputs:
             print_success("Geometric medians written to: " + options.fmedians)
 
         if options.statsfile:
-            stats = do_stats(df)
             if isinstance(options.statsfile, str):
-                with open(options.statsfile, 'wt') as f:
-                    stats.to_csv(f)
                 print_success("Stats written to: " + abspath(options.statsfile))
             else:
                 pd.set_option('precision', 7)
@@ -5,16 +5,25 @@
 # Created: 5 Dec. 2014
 #-------------------------------------------------------------------------------
 
+import re
+import json
 from os.path import basename, isdir, dirname
 
+import numpy as np
 import pandas as pd
-import igraph as gr
+
+from psense.util import rechunk
+from psense.index import UserIndex
+from psense.stats import group_users
+from psense.geojson import format_coordinates, write_features
 
 #-------------------------------------------------------------------------------
 
-def collect_data(json_files):
+def collect_data(json_files, users=None):
     """
     json_files: a list containing json path-strings
+    users: a psense.index.UserIndex in which to intern the reporter IDs,
+        added to the frame as a 'user_num' column (optional)
 
     Returns a sorted pandas.DataFrame object made up of all json objects
     together.
@@ -28,51 +37,146 @@ def collect_data(json_files):
         df_list.append(df)
 
     df = pd.concat(df_list) # merge list info one DF
-    df.sort(inplace=True)
+    df.sort_index(inplace=True, kind='mergesort')
+    if users is not None:
+        df = users.annotate(df, level=0)
+
+    return df
+
+JSON_EXTENSIONS = ['.json', '.ndjson', '.jsonl']
+_SEPARATORS = re.compile(r'[\s,]*')
 
+def iter_records(json_path, bufsize=1 << 16):
+    """
+    Generate the report objects of a JSON file, either an array of reports
+    or NDJSON (one report per line), reading `bufsize` bytes at a time.
+    """
+    decoder = json.JSONDecoder()
+    with open(json_path) as f:
+        buf = ""
+        while not buf: # skip the leading whitespace, however long
+            more = f.read(bufsize)
+            if not more:
+                break
+            buf = more.lstrip()
+        if not buf.startswith("["): # NDJSON
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        pos = 1
+        while True:
+            pos = _SEPARATORS.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == "]":
+                return
+            try:
+                if pos == len(buf):
+                    raise ValueError("Buffer exhausted")
+                obj, pos = decoder.raw_decode(buf, pos)
+            except ValueError: # incomplete object, read on
+                more = f.read(bufsize)
+                if not more:
+                    raise ValueError("Invalid or truncated JSON array: " + json_path)
+                buf, pos = buf[pos:] + more, 0
+                continue
+            yield obj
+
+def records_to_df(records):
+    """
+    Flatten a list of report objects into the columns 'pid' (the reporter
+    ID), 'created_at', 'lat', 'lng' and 'name' (the reporter name), leaving
+    out all other fields.
+    """
+    df = pd.DataFrame.from_records(records, columns=["reporter", "created_at", "lat", "lng"])
+    reporter = pd.DataFrame.from_records(df.pop("reporter").tolist(), columns=["id", "name"])
+    df.insert(0, "pid", reporter["id"].values) # pid ~ person id
+    df["name"] = reporter["name"].values
+    if df["created_at"].dtype.kind in "if": # epoch milliseconds
+        df["created_at"] = pd.to_datetime(df["created_at"], unit="ms")
+    else:
+        df["created_at"] = pd.to_datetime(df["created_at"])
     return df
 
-def build_df(json_path):
-    df = pd.read_json(json_path)
-    df["pid"] = [r["id"] for r in df.reporter] # pid ~ person id
-    df["name"] = [r["name"] for r in df.reporter]
-    df = df[["pid", "created_at", "lat", "lng", "name"]].sort(["pid", "created_at"]).set_index("pid")
+def iter_frames(json_path, chunksize=100000):
+    """
+    Generate the reports of a JSON or NDJSON file as flat DataFrames of at
+    most `chunksize` rows (see `records_to_df`), in file order.
+    """
+    records = []
+    for record in iter_records(json_path):
+        records.append(record)
+        if len(records) == chunksize:
+            yield records_to_df(records)
+            records = []
+    if records:
+        yield records_to_df(records)
+
+def build_df(json_path, chunksize=100000):
+    frames = list(iter_frames(json_path, chunksize)) or [records_to_df([])]
+    df = pd.concat(frames, ignore_index=True)
+    df = df.sort_values(["pid", "created_at"], kind='mergesort').set_index("pid")
 
     return df
 
-def df_to_graph(df):
-    # Build naked graph
-    g = gr.Graph(len(df.index.levels[0][1:])) # slice out first (anonymous) id
+def iter_chunks(json_files, chunksize=100000):
+    """
+    Generate the reports of the JSON files as DataFrames of `chunksize` rows
+    with the columns 'created_at', 'lat' and 'lng', indexed by 'user_id' (the
+    reporter ID), in file order. At most `chunksize` reports are parsed at
+    a time.
+    """
+    def frames():
+        for filepath in json_files:
+            for df in iter_frames(filepath, chunksize):
+                df = df.set_index("pid")[["created_at", "lat", "lng"]]
+                df.index.name = "user_id"
+                yield df
+    return rechunk(frames(), chunksize)
+
+def df_to_graph(df, users=None):
+    """
+    Build a naked graph whose vertex k is the user number k of `users` (by
+    default the mapping carried by `df`, see `UserIndex.from_df`). The
+    anonymous reporter (id 0), if any, is left as an isolated vertex.
+    """
+    import igraph as gr # only needed for graphs
+
+    users = users if users is not None else UserIndex.from_df(df, level=0)
+    g = gr.Graph(len(users))
+    g.vs["id"] = list(users.ids)
     return g
 
 #-------------------------------------------------------------------------------
 
 def write_geojson(df, outpath):
-    geojson = '{"type":"FeatureCollection","features":['
-
-    for pid, fr in df[df.index > 0].groupby(level=0): # exclude id 0 (anonymous)
-        name = df.ix[pid]["name"] if isinstance(df.ix[pid]["name"], unicode) \
-            else df.ix[pid]["name"].iloc[0] # take the first name in the list
-        geojson += ('{"type":"Feature","properties":{"id":'
-            + str(pid)
-            + ',"name":'
-            + '"%s"' % name
-            + '},"geometry":{"type":"LineString","coordinates":[')
-        for i, r in fr.iterrows():
-            c = "[{0},{1}],".format(r["lng"], r["lat"]) # geojson coordinates follow [lng, lat] formatting
-            geojson += c
-        geojson = geojson[:-1] + "]}}," # remove trailing comma of last coord.
-    geojson = geojson[:-1] + "]}" # remove trailing comma of last path
+    df = df[df.index > 0] # exclude id 0 (anonymous)
+    uids, starts, order = group_users(df, level=0)
+    lat = np.asarray(df["lat"], dtype=np.float64)[order]
+    lng = np.asarray(df["lng"], dtype=np.float64)[order]
+    names = np.asarray(df["name"])[order][starts[:-1]] # take the first name of each user
+
+    def features():
+        for pid, name, a, b in zip(uids, names, starts[:-1], starts[1:]):
+            # geojson coordinates follow [lng, lat] formatting
+            yield ('{"type":"Feature","properties":{"id":'
+                + str(pid)
+                + ',"name":'
+                + '"%s"' % name
+                + '},"geometry":{"type":"LineString","coordinates":['
+                + format_coordinates(lng[a:b], lat[a:b])
+                + ']}}')
 
     with open(outpath, "wt") as fout:
-        fout.write(geojson.encode('utf-8'))
+        write_features(fout, features())
 
 #-------------------------------------------------------------------------------
 
 if __name__ == '__main__':
     from optparse import OptionParser
 
-    usage = "./%prog [options] path\n\npath -- the path of a JSON file or a directory containing such files."
+    usage = "./%prog [options] path\n\npath -- the path of a JSON (or NDJSON) file or a directory containing such files."
     parser = OptionParser(usage=usage)
     parser.add_option("-w",
         dest="filename",
@@ -90,9 +194,9 @@ if __name__ == '__main__':
         if isdir(args[0]):
             dirpath = args[0]
             json_files = [abspath(join(dirpath, f)) for f in listdir(dirpath) \
-                if isfile(join(dirpath, f)) and splitext(f)[1] == '.json']
+                if isfile(join(dirpath, f)) and splitext(f)[1] in JSON_EXTENSIONS]
         elif all([isfile(a) for a in args]) \
-            and all([a.endswith('.json') for a in args]):
+            and all([splitext(a)[1] in JSON_EXTENSIONS for a in args]):
             json_files = [abspath(f) for f in args]
         else:
             raise IOError("Files must be in JSON format")
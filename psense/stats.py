@@ -5,13 +5,18 @@
 # Created: 4 Feb. 2015
 #-------------------------------------------------------------------------------
 
-import time
-from math import sqrt
+import ctypes
+import multiprocessing as mp
 
+import numpy as np
 import pandas as pd
 
 from geopy.distance import distance # VincentyDistance
-from psense.util import Point, EPSILON
+from psense.util import Point, EPSILON, haversine, row_metadata
+from psense.index import to_ns, UserIndex, user_numbers
+from psense.geojson import write_points
+
+STATS_COLUMNS = ["avg_locality", "med_locality", "radius_avg", "radius_med"] # of `user_stats`
 
 #-------------------------------------------------------------------------------
 
@@ -21,7 +26,7 @@ def df_to_points(df, tuples=True):
     else:
         points = []
         def build_point(row):
-            metadata = row.loc[:"text"].to_dict()
+            metadata = row_metadata(row)
             P = Point((row.lat, row.lng), metadata=metadata)
             points.append(P)
         df.apply(build_point, axis=1)
@@ -64,7 +69,7 @@ def geom_median_approx(P, points):
             y += Q[1] * w
     return (x / W, y / W)
 
-def geom_median(points, epsilon=EPSILON, user_id=None):
+def geom_median(points, epsilon=EPSILON, user_id=None, maxiter=1000):
     """
     Start with the centroid and apply Weiszfeld's algorithm until the
     distance between steps is less than `epsilon`.
@@ -74,26 +79,23 @@ def geom_median(points, epsilon=EPSILON, user_id=None):
         epsilon: tolerance / precision of the result in kilometers.
         user_id: For debugging purposes if `points` is a list of plain tuples
             without user metadata.
+        maxiter: maximum number of iterations.
 
-    Runtime: o(n^2)
+    Runtime: O(n * maxiter), see `geom_medians`.
 
     [Based on Gareth Rees' answer of 'Meeting Point problem from interviewstreet.com' in the Code Review Stack Exchange.]
     """
-    P = geom_average(points)
-    start = time.time()
-    while time.time() < start + sqrt(len(points)) / 2: # set a time limit
-        Q = geom_median_approx(P, points)
-        if distance(P, Q) < epsilon:
-            return Q
-        P = Q
-    else:
+    lat = np.array([P[0] for P in points], dtype=np.float64)
+    lng = np.array([P[1] for P in points], dtype=np.float64)
+    mlat, mlng, converged = geom_medians(lat, lng, np.array([0, len(points)]), epsilon, maxiter)
+    if not converged[0]:
         msg = "Geometric median approximation not converging. Stopping calculation."
         if user_id:
             msg = ("User %s: " % user_id) + msg
-        elif isinstance(P, Point):
-            msg = ("User %s: " % P["user_id"]) + msg
+        elif isinstance(points[0], Point):
+            msg = ("User %s: " % points[0]["user_id"]) + msg
         print msg
-        return Q
+    return (mlat[0], mlng[0])
 
 def radius(points, center_function=geom_average, center=None):
     C = center if center else center_function(points)
@@ -109,20 +111,458 @@ def locality(points, center_function=geom_average, center=None):
     return 1 / sum(dts)
 
 #-------------------------------------------------------------------------------
+# Grouped array versions of the functions above. The reports of each user are
+# laid out contiguously, user `u` owning the slice starts[u]:starts[u+1].
+
+def group_users(df, level="user_id", sort_time=False):
+    """
+    Group the reports of `df` by user without building sub-DataFrames.
+
+    If `df` has a 'user_num' column (see `psense.index.UserIndex`), its user
+    numbers are the group codes, and the users come in the order of their
+    numbers; otherwise in the order of their IDs.
+
+    Args:
+        df (pandas.DataFrame): Reports indexed by user.
+        level (str, optional): Index level holding the user IDs.
+        sort_time (bool, optional): Sort the reports of each user by
+            'created_at' instead of keeping their order in `df`.
+
+    Returns:
+        (uids, starts, order): the user IDs, the offsets of the
+        reports of each user, and the row positions in `df` that lay the
+        reports out contiguously by user.
+
+    Runtime: O(n * log(n))
+    """
+    ids = df.index.get_level_values(level)
+    if "user_num" in df:
+        # numbers of the users without reports in `df` are skipped
+        nums = user_numbers(df)
+        present = np.bincount(nums) > 0 if len(nums) else np.zeros(0, dtype=bool)
+        codes = (np.cumsum(present) - 1)[nums]
+        nusers = present.sum()
+    else:
+        codes, uids = pd.factorize(ids, sort=True)
+        nusers = len(uids)
+    if sort_time:
+        order = np.lexsort((to_ns(df["created_at"]), codes))
+    else:
+        order = np.argsort(codes, kind='mergesort')
+    counts = np.bincount(codes, minlength=nusers) if nusers else np.zeros(0, dtype=np.intp)
+    starts = np.concatenate(([0], np.cumsum(counts)))
+    if "user_num" in df:
+        uids = np.asarray(ids)[order][starts[:-1]]
+    return np.asarray(uids), starts, order
+
+def segment_ids(starts):
+    """Index of the segment (user) of each element."""
+    return np.repeat(np.arange(len(starts) - 1), np.diff(starts))
+
+def segment_sum(x, starts):
+    if len(starts) < 2:
+        return np.zeros(0, dtype=np.float64)
+    return np.add.reduceat(x, starts[:-1])
+
+def segment_max(x, starts):
+    if len(starts) < 2:
+        return np.zeros(0, dtype=np.float64)
+    return np.maximum.reduceat(x, starts[:-1])
+
+def geom_averages(lat, lng, starts):
+    """Centroid of each user, see `geom_average`."""
+    n = np.diff(starts).astype(np.float64)
+    return segment_sum(lat, starts) / n, segment_sum(lng, starts) / n
+
+def _weiszfeld_weights(lat, lng, plat, plng):
+    """Weights of the reports around the approximations of their users."""
+    d = haversine(lat, lng, plat, plng)
+    with np.errstate(divide='ignore'):
+        return np.where(d != 0, 1.0 / d, 0.0) # skip coinciding points
+
+def _weiszfeld_step(plat, plng, W, x, y, epsilon):
+    """
+    Move the approximations (plat, plng) of a set of users given the sums
+    of the weights `W` and of the weighted coordinates `x` and `y` of their
+    reports (see `_weiszfeld_weights`).
+
+    Returns:
+        (qlat, qlng, done): the new approximations, and a boolean array
+        flagging the users which converged.
+    """
+    # users whose points all coincide with the approximation stay there
+    stuck = W == 0
+    W = np.where(stuck, 1.0, W)
+    qlat = np.where(stuck, plat, x / W)
+    qlng = np.where(stuck, plng, y / W)
+    done = stuck | (haversine(plat, plng, qlat, qlng) < epsilon)
+    return qlat, qlng, done
+
+def geom_medians(lat, lng, starts, epsilon=EPSILON, maxiter=1000, init=None):
+    """
+    Run Weiszfeld's algorithm for all users at once, see `geom_median`.
+
+    Every iteration moves the median approximation of each user still
+    running. A user stops once a step is shorter than `epsilon` (in km), and
+    all users stop after `maxiter` iterations, so the result does not depend
+    on the machine load.
+
+    Args:
+        lat, lng (numpy.ndarray): Coordinates laid out contiguously by user.
+        starts (numpy.ndarray): Offsets of the reports of each user.
+        epsilon (float, optional): Tolerance of the result in kilometers.
+        maxiter (int, optional): Maximum number of iterations.
+        init (tuple, optional): Arrays (lat, lng) of starting points, e.g.
+            the medians of a previous run. Defaults to the centroids.
+
+    Returns:
+        (mlat, mlng, converged): the medians and a boolean array flagging the
+        users which converged within `maxiter` iterations.
+
+    Runtime: O(n * maxiter), n being the number of reports.
+    """
+    nusers = len(starts) - 1
+    seg = segment_ids(starts)
+    if init is None:
+        plat, plng = geom_averages(lat, lng, starts)
+    else:
+        plat, plng = [np.array(c, dtype=np.float64) for c in init]
+    converged = np.zeros(nusers, dtype=bool)
+    active = np.arange(nusers) # users still iterating
+    idx = np.arange(len(lat)) # reports of the active users
+    local = np.empty(nusers, dtype=np.intp)
+
+    for _ in range(maxiter):
+        if not len(active):
+            break
+        local[active] = np.arange(len(active))
+        useg = seg[idx]
+        lseg = local[useg]
+        w = _weiszfeld_weights(lat[idx], lng[idx], plat[useg], plng[useg])
+        W = np.bincount(lseg, w, minlength=len(active))
+        x = np.bincount(lseg, w * lat[idx], minlength=len(active))
+        y = np.bincount(lseg, w * lng[idx], minlength=len(active))
+        qlat, qlng, done = _weiszfeld_step(plat[active], plng[active], W, x, y, epsilon)
+        plat[active], plng[active] = qlat, qlng
+        converged[active[done]] = True
+        active = active[~done]
+        idx = idx[~converged[seg[idx]]]
+    return plat, plng, converged
+
+def center_distances(lat, lng, starts, clat, clng):
+    """Distance in km of every report to the center of its user."""
+    seg = segment_ids(starts)
+    return haversine(lat, lng, clat[seg], clng[seg])
+
+def user_centers(lat, lng, starts, center_function=geom_average):
+    """
+    Apply `center_function` to the reports of each user. The geometric
+    average and median are computed for all users at once.
+
+    Returns:
+        Arrays (lat, lng) of the centers.
+    """
+    if center_function in [geom_average, geom_mean]:
+        return geom_averages(lat, lng, starts)
+    elif center_function is geom_median:
+        return geom_medians(lat, lng, starts)[:2]
+    c = [center_function(zip(lat[a:b], lng[a:b])) for a, b in zip(starts[:-1], starts[1:])]
+    return (np.array([P[0] for P in c], dtype=np.float64),
+        np.array([P[1] for P in c], dtype=np.float64))
+
+def user_stats(lat, lng, starts, centers=None):
+    """
+    Compute the statistics of `do_stats` for all users at once.
+
+    Args:
+        lat, lng (numpy.ndarray): Coordinates laid out contiguously by user.
+        starts (numpy.ndarray): Offsets of the reports of each user.
+        centers (tuple, optional): The arrays (alat, alng, mlat, mlng) of
+            the geometric averages and medians, if already computed.
+
+    Returns:
+        A tuple of arrays (avg_locality, med_locality, radius_avg, radius_med).
+    """
+    if centers is not None:
+        alat, alng, mlat, mlng = centers
+    else:
+        alat, alng = user_centers(lat, lng, starts, geom_average)
+        mlat, mlng = user_centers(lat, lng, starts, geom_median)
 
-def do_stats(df, join=False):
     stats = []
+    with np.errstate(divide='ignore'):
+        for clat, clng in [(alat, alng), (mlat, mlng)]:
+            d = center_distances(lat, lng, starts, clat, clng)
+            stats.append((1 / segment_sum(d, starts), segment_max(d, starts)))
+    (lc_avg, avg_radius), (lc_med, med_radius) = stats
+    return lc_avg, lc_med, avg_radius, med_radius
+
+def segment_quantiles(x, starts, quantiles):
+    """
+    Quantiles of each segment, interpolated linearly as `numpy.percentile`
+    does. Empty segments give NaN.
+
+    Returns:
+        An array of shape (number of segments, len(quantiles)).
+    """
+    seg = segment_ids(starts)
+    x = x[np.lexsort((x, seg))]
+    n = np.diff(starts)
+    out = np.empty((len(n), len(quantiles)))
+    out.fill(np.nan)
+    full = n > 0
+    for k, q in enumerate(quantiles):
+        pos = starts[:-1][full] + q * (n[full] - 1)
+        lo = np.floor(pos).astype(np.intp)
+        hi = np.ceil(pos).astype(np.intp)
+        out[full, k] = x[lo] + (pos - lo) * (x[hi] - x[lo])
+    return out
+
+def user_mobility(lat, lng, cells, starts, quantiles=(0.5, 0.9)):
+    """
+    Compute mobility metrics for all users at once.
+
+    Args:
+        lat, lng (numpy.ndarray): Coordinates laid out contiguously by user,
+            in chronological order within each user.
+        cells (numpy.ndarray): Integer code of the place (e.g. grid cell) of
+            each report.
+        starts (numpy.ndarray): Offsets of the reports of each user.
+        quantiles (list, optional): Quantiles of the jump lengths.
+
+    Returns:
+        A tuple of arrays (radius_gyration, n_cells, entropy) followed by one
+        array per jump-length quantile.
+    """
+    n = np.diff(starts).astype(np.float64)
+    seg = segment_ids(starts)
+    # radius of gyration: root mean square distance to the centroid
+    alat, alng = geom_averages(lat, lng, starts)
+    d = center_distances(lat, lng, starts, alat, alng)
+    rg = np.sqrt(segment_sum(d ** 2, starts) / n)
+
+    # distinct places and visit entropy, from the (user, place) pairs
+    ncells = cells.max() + 1 if len(cells) else 1
+    pairs, visits = np.unique(seg * ncells + cells, return_counts=True)
+    puser = pairs // ncells
+    p = visits / n[puser]
+    ndistinct = np.bincount(puser, minlength=len(n))
+    entropy = -np.bincount(puser, p * np.log(p), minlength=len(n))
+
+    # jumps between consecutive reports of the same user
+    same = seg[1:] == seg[:-1]
+    jumps = haversine(lat[:-1], lng[:-1], lat[1:], lng[1:])[same]
+    jstarts = np.concatenate(([0], np.cumsum(np.bincount(seg[1:][same], minlength=len(n)))))
+    jq = segment_quantiles(jumps, jstarts, quantiles)
+    return (rg, ndistinct, entropy) + tuple(jq.T)
+
+def place_codes(df):
+    """
+    Integer code of the place of each report: its grid cell if `df` has an
+    'icell' column (see `Grid.build`), its exact location otherwise.
+    """
+    if "icell" in df:
+        return pd.factorize(df["icell"])[0]
+    la = pd.factorize(df["lat"])[0]
+    lo = pd.factorize(df["lng"])[0]
+    return pd.factorize(la.astype(np.int64) * (lo.max() + 1) + lo)[0]
+
+def mobility_stats(df, grid=None, quantiles=(0.5, 0.9)):
+    """
+    Compute the radius of gyration, the number of distinct places visited,
+    the visit entropy and the jump-length quantiles (in km) of each user.
+
+    Places are the cells of `grid` (or of the grid which built `df`, when it
+    has an 'icell' column), or the exact locations otherwise. If `grid` is
+    given, the metrics are computed on its reports `grid.df`.
+
+    Runtime: O(n * log(n))
+    """
+    if grid is not None:
+        df = grid.df
+    uids, starts, order = group_users(df, sort_time=True)
+    lat = np.asarray(df["lat"], dtype=np.float64)[order]
+    lng = np.asarray(df["lng"], dtype=np.float64)[order]
+    columns = ["radius_gyration", "n_cells", "entropy"] \
+        + ["jump_q%g" % (100 * q) for q in quantiles]
+    metrics = user_mobility(lat, lng, place_codes(df)[order], starts, quantiles)
+    return pd.DataFrame(dict(zip(columns, metrics)),
+        index=pd.Index(uids, name="user_id"), columns=columns)
+
+def bucket_medians(lat, lng, seg, mask, nusers):
+    """
+    Geometric median of the reports selected by `mask` for each user (NaN
+    for users without such reports). `seg` gives the user of each report.
+    """
+    counts = np.bincount(seg[mask], minlength=nusers)
+    has = counts > 0
+    mlat, mlng = np.empty(nusers), np.empty(nusers)
+    mlat.fill(np.nan)
+    mlng.fill(np.nan)
+    starts = np.concatenate(([0], np.cumsum(counts[has])))
+    mlat[has], mlng[has] = geom_medians(lat[mask], lng[mask], starts)[:2]
+    return mlat, mlng
 
-    for uid, r in df.groupby(level="user_id"):
-        p = df_to_points(r)
-        avg = geom_average(p)
-        med = geom_median(p)
-        lc_avg = locality(p, center=avg)
-        lc_med = locality(p, center=med)
-        avg_radius = radius(p, center=avg)
-        med_radius = radius(p, center=med)
-        stats.append((uid, lc_avg, lc_med, avg_radius, med_radius))
-    stats_df = pd.DataFrame(stats, columns=["user_id", "avg_locality", "med_locality", "radius_avg", "radius_med"]).set_index("user_id")
+def bucket_modes(codes, seg, mask, nusers):
+    """
+    Most frequent code among the reports selected by `mask` for each user
+    (-1 for users without such reports). Ties go to the smallest code.
+    """
+    ncodes = codes.max() + 1 if len(codes) else 1
+    pairs, counts = np.unique(seg[mask] * ncodes + codes[mask], return_counts=True)
+    puser = pairs // ncodes
+    o = np.lexsort((-counts, puser))
+    first = o[np.concatenate(([True], puser[o][1:] != puser[o][:-1]))] if len(o) else o
+    modes = -np.ones(nusers, dtype=np.int64)
+    modes[puser[first]] = pairs[first] % ncodes
+    return modes
+
+def anchor_stats(df, home_hours=(22, 6), work_hours=(9, 17), utc_offset=0, groups=None):
+    """
+    Infer the home and work locations of each user from the time of day of
+    the reports: the geometric median of the night-time reports (any day),
+    and that of the daytime reports on weekdays. If `df` has an 'icell'
+    column (e.g. `g.df`), the most visited cell of each period is added.
+
+    Args:
+        df (pandas.DataFrame): Reports indexed by user.
+        home_hours, work_hours (tuple, optional): (from, to) hours of the
+            day, the first included and the second not. Night periods wrap
+            around midnight.
+        utc_offset (float, optional): Hours to add to 'created_at' to get the
+            local time of the reports.
+        groups (tuple, optional): The output of `group_users(df)`, if already
+            computed (the order of the reports of each user does not matter).
+
+    Returns:
+        A DataFrame with the columns 'home_lat', 'home_lng', 'work_lat' and
+        'work_lng' (NaN without reports in the period), plus 'home_cell' and
+        'work_cell' for gridded reports.
+
+    Runtime: O(n * (log(n) + maxiter)), see `geom_medians`.
+    """
+    uids, starts, order = groups if groups is not None else group_users(df)
+    nusers = len(uids)
+    seg = segment_ids(starts)
+    lat = np.asarray(df["lat"], dtype=np.float64)[order]
+    lng = np.asarray(df["lng"], dtype=np.float64)[order]
+    ts = to_ns(df["created_at"])[order] + int(utc_offset * 3600 * 1e9)
+    hour = (ts // int(3600 * 1e9)) % 24
+    weekday = (ts // int(86400 * 1e9) + 3) % 7 # 1 Jan. 1970 was a Thursday
+
+    def within(hours):
+        begin, end = hours
+        if begin <= end:
+            return (hour >= begin) & (hour < end)
+        return (hour >= begin) | (hour < end)
+
+    masks = [("home", within(home_hours)), ("work", within(work_hours) & (weekday < 5))]
+    anchors = pd.DataFrame(index=pd.Index(uids, name="user_id"))
+    for name, mask in masks:
+        anchors[name + "_lat"], anchors[name + "_lng"] = bucket_medians(lat, lng, seg, mask, nusers)
+    if "icell" in df:
+        codes, cells = pd.factorize(df["icell"])
+        cells = np.concatenate((np.asarray(cells, dtype=object), [None])) # -1 -> None
+        for name, mask in masks:
+            anchors[name + "_cell"] = cells[bucket_modes(codes[order], seg, mask, nusers)]
+    return anchors
+
+#-------------------------------------------------------------------------------
+# Process pool over users. The coordinates are copied once into shared memory,
+# which the worker processes inherit, and each task only names a range of users.
+
+_shared = {}
+
+def _init_shared(lat, lng, starts):
+    _shared["lat"] = np.ctypeslib.as_array(lat)
+    _shared["lng"] = np.ctypeslib.as_array(lng)
+    _shared["starts"] = np.ctypeslib.as_array(starts)
+
+def _run_chunk(task):
+    func, args, u0, u1 = task
+    starts = _shared["starts"]
+    a, b = starts[u0], starts[u1]
+    return func(_shared["lat"][a:b], _shared["lng"][a:b], starts[u0:u1 + 1] - a, *args)
+
+def balanced_chunks(starts, nchunks):
+    """
+    Split the users into at most `nchunks` contiguous ranges [u0, u1)
+    holding about the same number of reports each.
+    """
+    nusers = len(starts) - 1
+    bounds = np.searchsorted(starts, np.linspace(0, starts[-1], nchunks + 1))
+    bounds = np.unique(np.concatenate(([0], np.clip(bounds, 0, nusers), [nusers])))
+    return zip(bounds[:-1], bounds[1:])
+
+def map_users(func, lat, lng, starts, args=(), workers=None):
+    """
+    Compute `func(lat, lng, starts, *args)` on balanced chunks of users in a
+    pool of `workers` processes and return the list of results, in user
+    order. `func` must be a module-level function. Without `workers`, `func`
+    is applied once on all the users.
+    """
+    if not workers or workers < 2 or len(starts) < 3:
+        return [func(lat, lng, starts, *args)]
+
+    def shared(a, ctype):
+        raw = mp.RawArray(ctype, len(a))
+        np.ctypeslib.as_array(raw)[:] = a
+        return raw
+
+    initargs = (shared(lat, ctypes.c_double), shared(lng, ctypes.c_double),
+        shared(starts, ctypes.c_int64))
+    # a few chunks per worker even out the load
+    tasks = [(func, args, u0, u1) for u0, u1 in balanced_chunks(starts, 4 * workers)]
+    pool = mp.Pool(workers, initializer=_init_shared, initargs=initargs)
+    try:
+        return pool.map(_run_chunk, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def merge_chunks(results):
+    """Concatenate the tuples of arrays returned by `map_users`."""
+    return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+#-------------------------------------------------------------------------------
+
+def do_stats(df, join=False, workers=None, mobility=False, quantiles=(0.5, 0.9), anchors=False, groups=None, centers=None):
+    """
+    Compute the locality and radius of each user with respect to both the
+    geometric average and the geometric median of the user's reports. With
+    `workers`, users are processed in a pool of that many processes.
+
+    If `mobility` is set, the columns of `mobility_stats` are added, computed
+    on the same grouped arrays. Pass a grid's DataFrame `g.df` to count
+    visited grid cells. If `anchors` is set, the home and work locations of
+    `anchor_stats` are added as well. The 'user_num' column of `df` (see
+    `psense.index.UserIndex`), if any, is carried over.
+
+    The output of `group_users(df, sort_time=mobility)` and the centers of
+    `user_stats` (in that user order) can be passed as `groups` and
+    `centers` to reuse them, see `psense.io_csv.export`.
+
+    Runtime: O(n * (log(n) + maxiter)), see `geom_medians`.
+    """
+    uids, starts, order = groups if groups is not None else group_users(df, sort_time=mobility)
+    lat = np.asarray(df["lat"], dtype=np.float64)[order]
+    lng = np.asarray(df["lng"], dtype=np.float64)[order]
+
+    columns = list(STATS_COLUMNS)
+    if centers is not None:
+        stats = user_stats(lat, lng, starts, centers)
+    else:
+        stats = merge_chunks(map_users(user_stats, lat, lng, starts, workers=workers))
+    if mobility:
+        columns += ["radius_gyration", "n_cells", "entropy"] \
+            + ["jump_q%g" % (100 * q) for q in quantiles]
+        stats += user_mobility(lat, lng, place_codes(df)[order], starts, quantiles)
+    stats_df = pd.DataFrame(dict(zip(columns, stats)),
+        index=pd.Index(uids, name="user_id"), columns=columns)
+    if "user_num" in df:
+        stats_df.insert(0, "user_num", np.asarray(df["user_num"])[order][starts[:-1]])
+    if anchors:
+        stats_df = stats_df.join(anchor_stats(df, groups=(uids, starts, order)))
 
     if join:
         df = df.join(stats_df)
@@ -131,14 +571,206 @@ def do_stats(df, join=False):
 
 #-------------------------------------------------------------------------------
 
-def write_geojson_centers(df, center_function, outpath):
-    geojson = '{"type":"FeatureCollection","features":['
+class OnlineStats(object):
+    """
+    Per-user statistics of `do_stats`, kept up to date as new batches of
+    reports arrive.
+
+    Each user keeps its report count and running coordinate sums, giving the
+    centroid, and its last median, which warm-starts Weiszfeld's algorithm on
+    the next update. Radii and localities depend on the (moving) centers, so
+    they are recomputed on the reports of the updated users only. This keeps
+    the coordinates of all the reports: use `chunked_stats` for corpora too
+    large for memory.
+
+    Common instantiation::
+        s = OnlineStats(df)
+        s.update(new_df)
+        s.snapshot()
+
+    Args:
+        df (pandas.DataFrame, optional): First batch of reports.
+        epsilon (float, optional): Tolerance of the medians in kilometers.
+        maxiter (int, optional): Maximum number of iterations of the medians.
+    """
+    columns = STATS_COLUMNS
+
+    def __init__(self, df=None, epsilon=EPSILON, maxiter=1000):
+        self.epsilon = epsilon
+        self.maxiter = maxiter
+        self.uids = []
+        self._index = {} # user ID -> row in the arrays below
+        self._lat = [] # coordinates of the reports of each user
+        self._lng = []
+        self._sums = np.zeros((0, 3)) # count, sum of lat, sum of lng
+        self._medians = np.zeros((0, 2))
+        self._stats = np.zeros((0, len(self.columns)))
+        if df is not None:
+            self.update(df)
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __repr__(self):
+        return "OnlineStats(%s users, %s reports)" % (len(self), int(self._sums[:, 0].sum()))
+
+    def _add_users(self, uids):
+        for uid in uids:
+            self._index[uid] = len(self.uids)
+            self.uids.append(uid)
+            self._lat.append(np.zeros(0))
+            self._lng.append(np.zeros(0))
+        k = len(uids)
+        self._sums = np.vstack((self._sums, np.zeros((k, 3))))
+        self._medians = np.vstack((self._medians, np.zeros((k, 2))))
+        self._stats = np.vstack((self._stats, np.zeros((k, len(self.columns)))))
+
+    def update(self, df):
+        """
+        Add a batch of reports and refresh the statistics of the users in it.
+
+        Returns:
+            The IDs of the updated users.
+
+        Runtime: O(m * maxiter), where m is the total number of reports of
+            the updated users.
+        """
+        uids, starts, order = group_users(df)
+        lat = np.asarray(df["lat"], dtype=np.float64)[order]
+        lng = np.asarray(df["lng"], dtype=np.float64)[order]
+        new = [uid for uid in uids if uid not in self._index]
+        isnew = np.array([uid not in self._index for uid in uids], dtype=bool)
+        self._add_users(new)
+
+        rows = np.array([self._index[uid] for uid in uids], dtype=np.intp)
+        for r, a, b in zip(rows, starts[:-1], starts[1:]):
+            self._lat[r] = np.concatenate((self._lat[r], lat[a:b]))
+            self._lng[r] = np.concatenate((self._lng[r], lng[a:b]))
+        self._sums[rows, 0] += np.diff(starts)
+        self._sums[rows, 1] += segment_sum(lat, starts)
+        self._sums[rows, 2] += segment_sum(lng, starts)
+
+        # all the reports of the updated users
+        ulat = np.concatenate([self._lat[r] for r in rows])
+        ulng = np.concatenate([self._lng[r] for r in rows])
+        ustarts = np.concatenate(([0], np.cumsum([len(self._lat[r]) for r in rows])))
 
-    for i, (uid, fr) in enumerate(df.groupby(level=0)):
-        points = df_to_points(fr)
-        c = center_function(points)
-        geojson += '{"type":"Feature","properties":{"number":%s,"id":%s},"geometry":{"type":"Point","coordinates":[%s, %s]}},' % (i, uid, c[1], c[0]) # [lng, lat] layout
-    geojson = geojson[:-1] + "]}" # remove trailing comma of last path
+        alat = self._sums[rows, 1] / self._sums[rows, 0]
+        alng = self._sums[rows, 2] / self._sums[rows, 0]
+        init = (np.where(isnew, alat, self._medians[rows, 0]),
+            np.where(isnew, alng, self._medians[rows, 1]))
+        mlat, mlng = geom_medians(ulat, ulng, ustarts, self.epsilon, self.maxiter, init)[:2]
+        self._medians[rows] = np.column_stack((mlat, mlng))
+        self._stats[rows] = np.column_stack(user_stats(ulat, ulng, ustarts, (alat, alng, mlat, mlng)))
+        return list(uids)
+
+    def snapshot(self):
+        """Return the statistics of all users, as the table of `do_stats`."""
+        stats_df = pd.DataFrame(self._stats, columns=self.columns,
+            index=pd.Index(self.uids, name="user_id"))
+        return stats_df.sort_index()
+
+def chunked_stats(chunks, epsilon=EPSILON, maxiter=50, users=None):
+    """
+    Compute the table of `do_stats` on reports read in chunks, holding one
+    chunk and a few arrays of the number of users in memory.
+
+    The chunks are read up to `maxiter + 2` times: one pass sums the
+    coordinates of each user (the centroids), each iteration of Weiszfeld's
+    algorithm is a pass summing the weighted coordinates of the users still
+    running (see `geom_medians`), and a last pass sums and maxes the
+    distances to the centers. Passes stop early once all the medians
+    converged, but chunks parsed from files are parsed again on each pass,
+    hence the small default `maxiter`; a `ReportStore` reads faster.
+
+    Args:
+        chunks (callable): Returns a new iterable of DataFrames of reports
+            indexed by 'user_id' at each call, e.g. `store.chunks` or
+            `lambda: iter_chunks(files)`.
+        epsilon (float, optional): Tolerance of the medians in kilometers.
+        maxiter (int, optional): Maximum number of iterations of the medians,
+            i.e. of passes over the chunks for them.
+        users (UserIndex, optional): The mapping of the corpus, e.g. the one
+            given to `build_df` or `store.user_index`. The per-user arrays
+            are indexed by its user numbers, read from the 'user_num' column
+            of the chunks if any, and the table gets a 'user_num' column,
+            in the order of the numbers. By default a new mapping is built.
+
+    Runtime: O(n * maxiter), n being the number of reports.
+    """
+    shared = users is not None
+    users = users if shared else UserIndex()
+
+    def read(grow=False):
+        # user numbers and coordinates of each chunk
+        for df in chunks():
+            ids = df.index.get_level_values("user_id")
+            if shared and "user_num" in df:
+                nums = user_numbers(df)
+                if grow and len(nums) and (nums.max() >= len(users)
+                        or (users.decode(nums) != np.asarray(ids)).any()):
+                    raise ValueError("The 'user_num' column of the chunks does not match `users`")
+            else:
+                codes, uniques = pd.factorize(ids)
+                nums = (users.add(uniques) if grow else users.encode(uniques))[codes]
+            yield (nums, np.asarray(df["lat"], dtype=np.float64),
+                np.asarray(df["lng"], dtype=np.float64))
+
+    def accumulate(totals, u, *weights):
+        # grow the per-user totals to the known users and add the weights
+        totals = [np.concatenate((t, np.zeros(len(users) - len(t)))) for t in totals]
+        if not len(users):
+            return totals
+        return [t + np.bincount(u, w, minlength=len(users)) for t, w in zip(totals, weights)]
+
+    n, alat, alng = [np.zeros(0)] * 3
+    for u, lat, lng in read(grow=True):
+        n, alat, alng = accumulate((n, alat, alng), u, np.ones(len(u)), lat, lng)
+    n, alat, alng = accumulate((n, alat, alng), np.zeros(0, dtype=np.intp), *[np.zeros(0)] * 3)
+    with np.errstate(divide='ignore', invalid='ignore'): # users without reports
+        alat, alng = alat / n, alng / n
+
+    nusers = len(users)
+    mlat, mlng = alat.copy(), alng.copy()
+    active = n > 0
+    for _ in range(maxiter):
+        if not active.any():
+            break
+        W, x, y = [np.zeros(nusers)] * 3
+        for u, lat, lng in read():
+            m = active[u]
+            u, lat, lng = u[m], lat[m], lng[m]
+            w = _weiszfeld_weights(lat, lng, mlat[u], mlng[u])
+            W, x, y = accumulate((W, x, y), u, w, w * lat, w * lng)
+        a = np.flatnonzero(active)
+        qlat, qlng, done = _weiszfeld_step(mlat[a], mlng[a], W[a], x[a], y[a], epsilon)
+        mlat[a], mlng[a] = qlat, qlng
+        active[a[done]] = False
+
+    totals = np.zeros((4, nusers)) # sums and maxima of the distances
+    for u, lat, lng in read():
+        d_avg = haversine(lat, lng, alat[u], alng[u])
+        d_med = haversine(lat, lng, mlat[u], mlng[u])
+        totals[0] += np.bincount(u, d_avg, minlength=nusers)
+        totals[1] += np.bincount(u, d_med, minlength=nusers)
+        np.maximum.at(totals[2], u, d_avg)
+        np.maximum.at(totals[3], u, d_med)
+
+    with np.errstate(divide='ignore'):
+        stats = [1 / totals[0], 1 / totals[1], totals[2], totals[3]]
+    present = np.flatnonzero(n > 0)
+    stats_df = pd.DataFrame(dict((c, x[present]) for c, x in zip(STATS_COLUMNS, stats)),
+        index=pd.Index(users.ids[present], name="user_id"), columns=STATS_COLUMNS)
+    if shared:
+        stats_df.insert(0, "user_num", present.astype(np.int32))
+        return stats_df
+    return stats_df.sort_index()
+
+#-------------------------------------------------------------------------------
 
-    with open(outpath, "wt") as fout:
-        fout.write(geojson.encode('utf-8'))
+def write_geojson_centers(df, center_function, outpath, workers=None):
+    uids, starts, order = group_users(df)
+    lat = np.asarray(df["lat"], dtype=np.float64)[order]
+    lng = np.asarray(df["lng"], dtype=np.float64)[order]
+    clat, clng = merge_chunks(map_users(user_centers, lat, lng, starts, (center_function,), workers))
+    write_points(outpath, uids, clat, clng)
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Created: 18 Oct. 2026
+#-------------------------------------------------------------------------------
+# Persistent, memory-mapped report store. A store is a directory holding one
+# .npy file per column, with the reports laid out contiguously by user and
+# sorted by time:
+#
+#   header.json   format version, number of reports and users, coordinate type,
+#                 user numbering
+#   users.npy     int64  user IDs by user number: sorted, or those of the
+#                 caller's `psense.index.UserIndex`
+#   offsets.npy   int64  reports of user u are the rows offsets[u]:offsets[u+1]
+#   uid.npy       int32  user number (position in users.npy) of each report
+#   ts.npy        int64  timestamps in nanoseconds
+#   lat.npy       float64 degrees, or int32 microdegrees
+#   lng.npy       float64 degrees, or int32 microdegrees
+#
+# Columns are opened read-only with `numpy.load(mmap_mode='r')`, so slices are
+# views on the page cache, shared by all the processes reading the store.
+#-------------------------------------------------------------------------------
+
+import json
+import multiprocessing as mp
+from os import makedirs, remove
+from os.path import join, isdir, isfile
+
+import numpy as np
+import pandas as pd
+
+from psense.index import to_ns, UserIndex
+from psense.stats import _shared, _run_chunk, balanced_chunks, merge_chunks, \
+    user_stats, STATS_COLUMNS
+
+VERSION = 1
+COLUMNS = ["uid", "ts", "lat", "lng"]
+
+#-------------------------------------------------------------------------------
+
+class MicrodegreeColumn(object):
+    """
+    Read-only view of a column of int32 microdegrees as float64 degrees,
+    decoded slice by slice.
+    """
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __getitem__(self, key):
+        return self.raw[key] * 1e-6
+
+    def __array__(self, dtype=None):
+        a = self[:]
+        return a if dtype is None else a.astype(dtype)
+
+#-------------------------------------------------------------------------------
+
+class ReportStore(object):
+    """
+    Memory-mapped store of the (user_id, created_at, lat, lng) columns of the
+    reports, see the layout above.
+
+    Common instantiation::
+        ReportStore.create(path, df)   # or an iterable of chunks
+        store = ReportStore(path)
+
+    Args:
+        path (str): Directory of the store.
+
+    Runtime:
+        O(1) to open. Slicing the columns of a range of users is O(1), and
+        reading it only touches the pages of that range.
+    """
+    def __init__(self, path):
+        if not isfile(join(path, "header.json")):
+            raise IOError("No report store at: " + path)
+        with open(join(path, "header.json")) as f:
+            self.header = json.load(f)
+        if self.header["version"] != VERSION:
+            raise ValueError("Unsupported report store version: %s" % self.header["version"])
+        self.path = path
+        load = lambda name: np.load(join(path, name + ".npy"), mmap_mode='r')
+        self.users = np.array(load("users")) # small, and pandas hashes it
+        self.offsets = load("offsets")
+        self.uid = load("uid")
+        self.ts = load("ts")
+        self.lat, self.lng = load("lat"), load("lng")
+        self._user_index = None
+        if self.microdegrees:
+            self.lat, self.lng = MicrodegreeColumn(self.lat), MicrodegreeColumn(self.lng)
+
+    def __len__(self):
+        return self.header["nreports"]
+
+    def __repr__(self):
+        return "ReportStore(%s reports, %s users)" % (len(self), len(self.users))
+
+    def user_slice(self, uid):
+        """Rows of the reports of the user `uid`."""
+        if uid not in self.user_index:
+            raise ValueError("%s not in the store" % uid)
+        u = self.user_index.encode([uid])[0]
+        return slice(self.offsets[u], self.offsets[u + 1])
+
+    def frame(self, rows=slice(None)):
+        """
+        DataFrame of the reports in `rows` (all by default), indexed by
+        'user_id' with the columns 'created_at', 'lat' and 'lng', as read by
+        `psense.io_csv.build_df`, and 'user_num' first if the store keeps
+        the caller's user numbers. This copies the rows.
+        """
+        uid = np.asarray(self.uid[rows])
+        df = pd.DataFrame({
+            "created_at": pd.to_datetime(np.asarray(self.ts[rows])),
+            "lat": np.asarray(self.lat[rows], dtype=np.float64),
+            "lng": np.asarray(self.lng[rows], dtype=np.float64)},
+            index=pd.Index(self.users[uid], name="user_id"),
+            columns=["created_at", "lat", "lng"])
+        if self.interned:
+            df.insert(0, "user_num", uid)
+        return df
+
+    def user_frame(self, uids):
+        """Reports of the users `uids`, see `frame`."""
+        return pd.concat([self.frame(self.user_slice(uid)) for uid in uids])
+
+    def chunks(self, chunksize=100000):
+        """
+        Generate the reports as DataFrames of `chunksize` rows, for
+        `Grid.build_chunks`, `TimeGrid.build_chunks` or `OnlineStats.update`
+        (pass the method itself to `psense.stats.chunked_stats`).
+        """
+        for a in range(0, len(self), chunksize):
+            yield self.frame(slice(a, a + chunksize))
+
+    def map_users(self, func, args=(), workers=None):
+        """
+        Like `psense.stats.map_users` on the coordinates of the store, but
+        the worker processes map the store themselves instead of receiving
+        a copy of the coordinates. Users without reports are skipped.
+        """
+        starts = self.starts
+        if not workers or workers < 2 or len(starts) < 3:
+            return [func(np.asarray(self.lat), np.asarray(self.lng), starts, *args)]
+        tasks = [(func, args, u0, u1) for u0, u1 in balanced_chunks(starts, 4 * workers)]
+        pool = mp.Pool(workers, initializer=_open_shared, initargs=(self.path,))
+        try:
+            return pool.map(_run_chunk, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def stats(self, workers=None):
+        """
+        Locality and radius of each user with reports, as the table of
+        `do_stats` (with 'user_num' if the store keeps the caller's numbers).
+        """
+        stats = merge_chunks(self.map_users(user_stats, workers=workers))
+        present = np.flatnonzero(np.diff(self.offsets) > 0)
+        stats_df = pd.DataFrame(dict(zip(STATS_COLUMNS, stats)),
+            index=pd.Index(np.asarray(self.users)[present], name="user_id"), columns=STATS_COLUMNS)
+        if self.interned:
+            stats_df.insert(0, "user_num", present.astype(np.int32))
+        return stats_df
+
+    # -- CLASS METHODS --
+    @classmethod
+    def create(cls, path, reports, microdegrees=False, blocksize=1 << 20, users=None):
+        """
+        Write a store from a DataFrame of reports indexed by 'user_id', or
+        from an iterable of such DataFrames (e.g. `psense.io_csv.iter_chunks`).
+
+        The chunks are first appended to raw column files, then sorted by
+        user and time block by block, so memory only holds a few int64
+        arrays (user numbers, sort order) of the length of the corpus.
+        User IDs must be integers.
+
+        Given `users`, the store keeps its user numbers instead of numbering
+        the sorted IDs: new IDs are added to it, its users without reports
+        get empty ranges, and `frame` adds the 'user_num' column.
+
+        Args:
+            path (str): Directory of the store, created if needed.
+            reports (pandas.DataFrame or iterable): The reports.
+            microdegrees (bool, optional): Store the coordinates as int32
+                microdegrees (about 0.1m of precision) instead of float64.
+            blocksize (int, optional): Number of rows copied at a time.
+            users (UserIndex, optional): The mapping of the corpus, e.g. the
+                one given to `build_df`.
+
+        Returns:
+            The opened ReportStore.
+        """
+        if not isdir(path):
+            makedirs(path)
+        frames = [reports] if isinstance(reports, pd.DataFrame) else reports
+        ctype = np.int32 if microdegrees else np.float64
+        raw = dict((c, open(join(path, c + ".raw"), "wb")) for c in COLUMNS)
+        n = 0
+        try:
+            for df in frames:
+                np.asarray(df.index.get_level_values("user_id"), dtype=np.int64).tofile(raw["uid"])
+                to_ns(df["created_at"]).tofile(raw["ts"])
+                for c in ["lat", "lng"]:
+                    x = np.asarray(df[c], dtype=np.float64)
+                    if microdegrees:
+                        x = np.round(x * 1e6)
+                    x.astype(ctype).tofile(raw[c])
+                n += len(df)
+        finally:
+            for f in raw.values():
+                f.close()
+
+        rawmap = lambda c, dtype: np.memmap(join(path, c + ".raw"), dtype=dtype, mode='r', shape=(n,)) \
+            if n else np.zeros(0, dtype=dtype)
+        if users is None:
+            ids, codes = np.unique(rawmap("uid", np.int64), return_inverse=True)
+        else:
+            codes, uniques = pd.factorize(np.array(rawmap("uid", np.int64)))
+            codes = users.add(uniques)[codes]
+            try:
+                ids = np.asarray(users.ids, dtype=np.int64)
+            except (TypeError, ValueError):
+                raise ValueError("The user IDs of a store must be integers, without gaps")
+        ts = np.array(rawmap("ts", np.int64))
+        order = np.lexsort((ts, codes))
+        del ts
+
+        def write(name, values):
+            np.save(join(path, name + ".npy"), values)
+
+        def write_sorted(name, src, dtype):
+            out = np.lib.format.open_memmap(join(path, name + ".npy"), mode='w+', dtype=dtype, shape=(n,))
+            for a in range(0, n, blocksize):
+                out[a:a + blocksize] = src[order[a:a + blocksize]]
+            out.flush()
+            del out
+
+        write("users", ids)
+        write("offsets", np.concatenate(([0], np.cumsum(np.bincount(codes, minlength=len(ids))))).astype(np.int64))
+        write_sorted("uid", codes.astype(np.int32), np.int32)
+        del codes
+        write_sorted("ts", rawmap("ts", np.int64), np.int64)
+        for c in ["lat", "lng"]:
+            write_sorted(c, rawmap(c, ctype), ctype)
+        for c in COLUMNS:
+            remove(join(path, c + ".raw"))
+
+        header = {"version": VERSION, "nreports": n, "nusers": len(ids),
+            "coordinates": "microdegrees" if microdegrees else "degrees",
+            "numbering": "sorted" if users is None else "interned"}
+        with open(join(path, "header.json"), "w") as f:
+            json.dump(header, f, indent=2, sort_keys=True)
+        return cls(path)
+
+    # -- PROPERTIES --
+    @property
+    def microdegrees(self):
+        return self.header["coordinates"] == "microdegrees"
+
+    @property
+    def interned(self):
+        """Whether the store keeps the user numbers of a caller's `UserIndex`."""
+        return self.header.get("numbering") == "interned"
+
+    @property
+    def user_index(self):
+        """The `UserIndex` of the user numbers of the store."""
+        if self._user_index is None:
+            self._user_index = UserIndex(self.users)
+        return self._user_index
+
+    @property
+    def starts(self):
+        """Offsets of the users with reports (see `psense.stats.group_users`)."""
+        return np.unique(np.asarray(self.offsets))
+
+#-------------------------------------------------------------------------------
+
+class TextStore(object):
+    """
+    Texts of the reports, kept out of the DataFrame: the utf-8 encoded texts
+    are concatenated in `<path>.txt` and their offsets stored in
+    `<path>.offsets.npy`. Both are memory-mapped, and a text is only decoded
+    when accessed by its row number. Missing texts are stored as empty.
+
+    Common instantiation::
+        TextStore.create(path, df["text"])
+        texts = TextStore(path)
+        texts[df["text_row"].iloc[0]]
+    """
+    def __init__(self, path):
+        self.path = path
+        self.offsets = np.load(path + ".offsets.npy", mmap_mode='r')
+        self.blob = np.memmap(path + ".txt", dtype=np.uint8, mode='r') \
+            if self.offsets[-1] else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __repr__(self):
+        return "TextStore(%s texts)" % len(self)
+
+    def __getitem__(self, row):
+        if isinstance(row, (slice, list, np.ndarray, pd.Series)):
+            rows = np.arange(len(self))[row] if isinstance(row, slice) else np.asarray(row)
+            return [self[r] for r in rows]
+        a, b = self.offsets[row], self.offsets[row + 1]
+        return self.blob[a:b].tostring().decode('utf-8')
+
+    # -- CLASS METHODS --
+    @classmethod
+    def create(cls, path, texts):
+        """Write the `texts` (any iterable of strings) and open the store."""
+        offsets = [0]
+        with open(path + ".txt", "wb") as f:
+            for text in texts:
+                if isinstance(text, unicode):
+                    text = text.encode('utf-8')
+                elif not isinstance(text, str):
+                    text = "" # missing
+                f.write(text)
+                offsets.append(offsets[-1] + len(text))
+        np.save(path + ".offsets.npy", np.array(offsets, dtype=np.int64))
+        return cls(path)
+
+def memory_per_row(df):
+    """Bytes per row of `df`, including its index and Python objects."""
+    return df.memory_usage(index=True, deep=True).sum() / float(max(len(df), 1))
+
+def compact(df, text_path=None, verbose=True):
+    """
+    Shrink a frame of reports: categorical user index (int8 to int32 codes),
+    float32 coordinates (about 1m of precision) and, if `text_path` is given,
+    the 'text' column replaced by its row in a `TextStore` ('text_row').
+    Timestamps are kept as datetime64 (int64). Coordinates are stored as
+    microdegrees in `ReportStore` only, since the analyses expect degrees.
+
+    Returns:
+        The compacted copy of `df`.
+    """
+    before = memory_per_row(df)
+    df = df.copy()
+    df.index = pd.CategoricalIndex(df.index, name=df.index.name)
+    for c in ["lat", "lng"]:
+        df[c] = df[c].astype(np.float32)
+    if text_path is not None and "text" in df:
+        TextStore.create(text_path, df["text"])
+        df["text_row"] = np.arange(len(df), dtype=np.int32 if len(df) < 2 ** 31 else np.int64)
+        # keep the column layout, see `psense.util.row_metadata`
+        columns = [c if c != "text" else "text_row" for c in df.columns if c != "text_row"]
+        df = df[columns]
+    if verbose:
+        print "Memory: %.1f bytes per row (%.1f before)" % (memory_per_row(df), before)
+    return df
+
+#-------------------------------------------------------------------------------
+
+def _open_shared(path):
+    """Pool initializer: map the store in the worker, see `_run_chunk`."""
+    store = ReportStore(path)
+    _shared["lat"], _shared["lng"] = store.lat, store.lng
+    _shared["starts"] = store.starts
+
+#-------------------------------------------------------------------------------
@@ -27,36 +27,54 @@
 import datetime as dt
 from psense.util import *
 from psense.grid import *
+from psense.index import to_ns
+from psense.trajectory import densify
 
 # ------------------------------------------------------------------------------
 
-def get_rendezvous(g, uid):
+def is_virtual(point):
+    """Whether `point` was interpolated by `densify`."""
+    return bool(point.metadata.get('virtual', False))
+
+def get_user_cells(g, uid, virtual=True):
+    """
+    Get the cells of the user `uid`, leaving out those only reached by
+    virtual reports (see `densify`) unless `virtual` is set.
+    """
+    if virtual or 'virtual' not in g.df:
+        return g.get_cells(uid)
+    rows = g.df.loc[[uid]]
+    return list(set(rows.icell[~rows.virtual.astype(bool)]))
+
+def get_rendezvous(g, uid, virtual=True):
     """
     Get the number of cell coincidences with other users for a given user.
+    Virtual reports (see `densify`) are left out unless `virtual` is set.
 
     Runtime:
         O(M * N), where M is the maximum number entries per user and N is the
         length of the data
     """
     rendezvous = []
-    for cell in g.get_cells(uid):
+    for cell in get_user_cells(g, uid, virtual):
         for point in g.get_points(cell):
-            if point['user_id'] != uid:
+            if point['user_id'] != uid and (virtual or not is_virtual(point)):
                 rendezvous.append(point)
     return rendezvous
 
-def get_rendezvous_users(g, uid):
+def get_rendezvous_users(g, uid, virtual=True):
     """
     Get the users with which the user with ID `uid` shares a cell (rendezvous).
     """
     rvs_users = []
-    for cell in g.get_cells(uid):
+    for cell in get_user_cells(g, uid, virtual):
         for point in g.get_points(cell):
-            if point['user_id'] != uid and point['user_id'] not in rvs_users:
+            if point['user_id'] != uid and point['user_id'] not in rvs_users \
+                and (virtual or not is_virtual(point)):
                 rvs_users.append(point['user_id'])
     return rvs_users
 
-def get_spatial_rendezvous_users(g, uid):
+def get_spatial_rendezvous_users(g, uid, virtual=True):
     """
     Get the users with which the user `uid` shares a spatial cell
     (time-independently).
@@ -64,19 +82,21 @@ def get_spatial_rendezvous_users(g, uid):
     if isinstance(g, TimeGrid):
         g = g.projection
     srvs_users = []
-    for cell in g.get_cells(uid):
+    for cell in get_user_cells(g, uid, virtual):
         for point in g.get_points(cell):
-            if point['user_id'] != uid:
+            if point['user_id'] != uid and (virtual or not is_virtual(point)):
                 srvs_users.append(point['user_id'])
     return srvs_users
 
-def measure_rendezvous(g, uid):
+def measure_rendezvous(g, uid, virtual_weight=1.0):
     """
     Compute the number of rendezvous of a given user.
 
     Args:
         g (TimeGrid): A data-populated three dimensional grid.
         uid (int): The ID of a user in the dataframe of `g`.
+        virtual_weight (float, optional): Weight of the rendezvous with
+            virtual reports (see `densify`). 0 leaves them out.
 
     Returns:
         The number of rendezvous of the user with ID `uid`, which is defined by
@@ -88,9 +108,12 @@ def measure_rendezvous(g, uid):
         to find a non-empty cell (or a 'dense' cell), then we get an average
         time of O(M).
     """
-    return len(get_rendezvous(g, uid))
+    if virtual_weight == 1.0:
+        return len(get_rendezvous(g, uid))
+    return sum(virtual_weight if is_virtual(P) else 1.0
+        for P in get_rendezvous(g, uid, virtual=virtual_weight > 0))
 
-def measure_rendezvous_users(g, uid):
+def measure_rendezvous_users(g, uid, virtual=True):
     """
     Compute the number of rendezvous users of a given user.
 
@@ -102,9 +125,9 @@ def measure_rendezvous_users(g, uid):
         O(M^2 * N), M is the maximum number entries per user and N is the length
         of the data.
     """
-    return len(get_rendezvous_users(g, uid))
+    return len(get_rendezvous_users(g, uid, virtual))
 
-def measure_spatial_rendezvous_users(g, uid):
+def measure_spatial_rendezvous_users(g, uid, virtual=True):
     """
     Compute the number of spatial rendezvous users of a given user.
 
@@ -118,9 +141,9 @@ def measure_spatial_rendezvous_users(g, uid):
 
     This approach assumes the user data reflects general movement patterns that are not time-specific.
     """
-    return len(get_spatial_rendezvous_users(g, uid))
+    return len(get_spatial_rendezvous_users(g, uid, virtual))
 
-def get_central_user(g, mode="all", all=False):
+def get_central_user(g, mode="all", all=False, **kwargs):
     """
     General parent function to find a 'central' user maximizing different grid rendezvous measures.
 
@@ -130,6 +153,8 @@ def get_central_user(g, mode="all", all=False):
             `maxfunctions` dictionary.
         all (bool, optional): decide whether to return only the first or all
             maxima. Defaults to False.
+        kwargs: passed on to the measure, e.g. `virtual=False` (or
+            `virtual_weight` for mode "all") to leave out virtual reports.
 
     Runtimes:
     - [all] measure_rendezvous
@@ -166,7 +191,7 @@ def get_central_user(g, mode="all", all=False):
     m = 0
     maxuser = []
     for uid in g.userlist:
-        n = max_function(g, uid)
+        n = max_function(g, uid, **kwargs)
         if not all:
             if n > m:
                 maxuser = uid
@@ -215,11 +240,15 @@ class TimeGrid(Grid):
         self.df = df # points (users) DataFrame
         self.tbox = tbox
         self._updateTime = False
+        self._countarray = None # counts of a grid built by `build_chunks`
 
     def __str__(self):
         return repr(self)
 
     def __repr__(self):
+        if self.df is None and self._countarray is not None:
+            return "TimeGrid(%s, %s non-empty cells, %s points)" % (self.shape,
+                np.count_nonzero(self._countarray), self._countarray.sum())
         return "TimeGrid(%s, %s non-empty cells, %s points)" % (self.shape, len(self.data), len(self.df))
 
     def __getitem__(self, cellindex):
@@ -258,33 +287,56 @@ class TimeGrid(Grid):
 
         index = tuple(index)
         self.data.insert(index, P)
+        self._sat = None
         return index
 
+    def _resized(self, gridsize):
+        return self.__class__(self.bbox, tbox=self.tbox, gridsize=gridsize, tres=self.tres, lazy=self.lazy)
+
+    def locate(self, lat, lng, ts):
+        """
+        Return the cell indices (times, rows, columns) of arrays of points
+        inside the bbox and tbox, as `add_point` would.
+        """
+        i, j = super(TimeGrid, self).locate(lat, lng)
+        seconds = (to_ns(ts) - to_ns(self.tbox[0])) / 1e9
+        t = (seconds / self.tres.total_seconds()).astype(np.intp)
+        return t, i, j
+
     # -- CLASS METHODS --
     @classmethod
-    def build(cls, df, bbox=None, tbox=None, gridsize=1.0, tres=24, lazy=0, bound_dense=False):
+    def build(cls, df, bbox=None, tbox=None, gridsize=1.0, tres=24, lazy=0, bound_dense=False, sindex=None, tindex=None, interpolate=None):
         """
         Return the cell of size `gridsize` with the highest all-time record count.
+        If a `SpatialIndex` or a `TimeIndex` on `df` is given, it is used to
+        bound `df` to `bbox` and `tbox`.
+
+        If `interpolate` is given (True, or a dict of `densify` arguments),
+        virtual reports are inserted between the reports of each user before
+        building the grid. The indices do not apply to the densified reports.
 
         Runtime:
             O(S + (m * n)), where S is the size of `df` and (m, n) is the
             dimension of the grid. (m * n) just comes from initializing the
             grid.
         """
+        if interpolate:
+            df = densify(df, **(interpolate if isinstance(interpolate, dict) else {}))
+            sindex = tindex = None
         if bound_dense:
-            tbox = get_dense_timespan(df)
+            tbox = get_dense_timespan(df, tindex=tindex)
         elif tbox is None:
-            tbox = get_timespan(df)
+            tbox = get_timespan(df, tindex)
         # initialize grid
         g = cls(bbox, tbox=tbox, gridsize=gridsize, tres=tres, lazy=lazy)
         # define row vector function
         def add_point(row):
-            metadata = row.loc[:"text"].to_dict()
+            metadata = row_metadata(row)
             P = Point((row.lat, row.lng), metadata=metadata)
             # modify g and return the cell index
             return [g.add_point(P)]
-        # bound dataframe to bbox (and make 'user_id' a column)
-        df_bounded = bound(df, bbox).reset_index()
+        # bound dataframe to bbox and tbox (and make 'user_id' a column)
+        df_bounded = bound_spacetime(df, bbox, tbox, sindex, tindex).reset_index()
         # loop through the dataframe and register each report in the grid.
         df_bounded["icell"] = df_bounded.apply(add_point, axis=1).iloc[:, 0]
         # set 'user_id' back to index
@@ -293,6 +345,25 @@ class TimeGrid(Grid):
         g.df = df_bounded
         return g
 
+    @classmethod
+    def build_chunks(cls, chunks, bbox, tbox, gridsize=1.0, tres=24, lazy=0):
+        """
+        Count the reports of an iterable of DataFrames in each cell, holding
+        one chunk in memory at a time (see `Grid.build_chunks`). Both `bbox`
+        and `tbox` are required, since they cannot be known before the end
+        of the stream.
+        """
+        g = cls(bbox, tbox=tbox, gridsize=gridsize, tres=tres, lazy=lazy)
+        counts = np.zeros(g.shape, dtype=np.int64)
+        for chunk in chunks:
+            chunk = bound_spacetime(chunk, bbox, tbox)
+            t, i, j = g.locate(np.asarray(chunk["lat"]), np.asarray(chunk["lng"]), chunk["created_at"])
+            flat = np.ravel_multi_index((t, i, j), counts.shape)
+            counts += np.bincount(flat, minlength=counts.size).reshape(counts.shape)
+        g._countarray = counts
+        g._sizematrix = np.matrix(counts.sum(axis=0))
+        return g
+
     # -- PROPERTIES --
     @property
     def tres(self):
@@ -357,6 +428,16 @@ class TimeGrid(Grid):
                 m[i[1:]] += len(self.data[i])
             return m
 
+    @property
+    def countarray(self):
+        """Number of points in each (time, row, column) cell."""
+        if self._countarray is not None and self._data is None:
+            return self._countarray
+        a = np.zeros(self.shape, dtype=np.int64)
+        for i in self.data:
+            a[i] = len(self.data[i])
+        return a
+
     @property
     def timerange(self):
         if self.tres and (self._timerange is None or self._updateTime):
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#-------------------------------------------------------------------------------
+# Created: 18 Oct. 2026
+#-------------------------------------------------------------------------------
+# Per-user trajectory processing. The reports of each user are handled as
+# chronologically sorted coordinate arrays (see `psense.stats.group_users`).
+#-------------------------------------------------------------------------------
+
+import numpy as np
+import pandas as pd
+
+from psense.util import haversine, EARTH_RADIUS
+from psense.index import to_ns
+from psense.stats import group_users, geom_averages, segment_ids
+
+#-------------------------------------------------------------------------------
+
+def _nanoseconds(minutes):
+    if isinstance(minutes, (pd.Timedelta, np.timedelta64)) or hasattr(minutes, 'days'):
+        return pd.Timedelta(minutes).value
+    return int(minutes * 60 * 1e9)
+
+def user_stays(lat, lng, ts, distance=0.2, duration=20):
+    """
+    Find the stays of a single user: maximal runs of consecutive reports
+    within `distance` km of the first report of the run, spanning at least
+    `duration`.
+
+    Args:
+        lat, lng (numpy.ndarray): Coordinates, sorted by time.
+        ts (numpy.ndarray): Timestamps as int64 nanoseconds, sorted.
+        distance (float, optional): Radius of a stay in kilometers.
+        duration (float or datetime.timedelta, optional): Minimum time spent
+            in minutes.
+
+    Returns:
+        A list of (first, last) report positions, one pair per stay.
+
+    Runtime: O(n). The distances from the first report of a run are
+        computed in blocks that double in size, so each report is visited a
+        constant number of times on average.
+    """
+    mintime = _nanoseconds(duration)
+    n = len(lat)
+    stays = []
+    i = 0
+    while i < n:
+        # find the end j of the run anchored at i
+        j = i + 1
+        block = 16
+        while j < n:
+            d = haversine(lat[i], lng[i], lat[j:j + block], lng[j:j + block])
+            far = np.nonzero(d > distance)[0]
+            if len(far):
+                j += far[0]
+                break
+            j += block
+            block *= 2
+        j = min(j, n)
+        if ts[j - 1] - ts[i] >= mintime:
+            stays.append((i, j - 1))
+        i = j
+    return stays
+
+def iter_stays(df, distance=0.2, duration=20):
+    """
+    Generate the stays of each user of `df`, one user at a time.
+
+    Yields:
+        (uid, stays) pairs, where `stays` is a DataFrame with the columns of
+        `stay_points`, or None if the user has no stay.
+        The 'user_num' column of `df`, if any, is carried over.
+    """
+    uids, starts, order = group_users(df, sort_time=True)
+    lat = np.asarray(df["lat"], dtype=np.float64)[order]
+    lng = np.asarray(df["lng"], dtype=np.float64)[order]
+    ts = to_ns(df["created_at"])[order]
+    nums = np.asarray(df["user_num"])[order] if "user_num" in df else None
+
+    for uid, a, b in zip(uids, starts[:-1], starts[1:]):
+        runs = user_stays(lat[a:b], lng[a:b], ts[a:b], distance, duration)
+        if not runs:
+            yield uid, None
+            continue
+        first, last = [np.array(r, dtype=np.intp) for r in zip(*runs)]
+        n = last - first + 1
+        # mean location of each run, from cumulative sums
+        slat = np.concatenate(([0], np.cumsum(lat[a:b])))
+        slng = np.concatenate(([0], np.cumsum(lng[a:b])))
+        clat = (slat[last + 1] - slat[first]) / n
+        clng = (slng[last + 1] - slng[first]) / n
+        stays = pd.DataFrame({
+            "created_at": pd.to_datetime(ts[a:b][first]),
+            "end": pd.to_datetime(ts[a:b][last]),
+            "n_reports": n,
+            "lat": clat,
+            "lng": clng},
+            index=pd.Index([uid] * len(runs), name="user_id"),
+            columns=["created_at", "end", "n_reports", "lat", "lng"])
+        if nums is not None:
+            stays.insert(0, "user_num", np.repeat(nums[a], len(runs)))
+        yield uid, stays
+
+def stay_points(df, distance=0.2, duration=20):
+    """
+    Reduce the reports of `df` to stay points: places where a user remained
+    within `distance` km for at least `duration` minutes.
+
+    The result is indexed by 'user_id' and has the columns 'created_at' (the
+    start of the stay), 'end', 'n_reports', 'lat' and 'lng' (the mean
+    location of the stay), so it can stand in for the reports in the grid
+    builders and `do_stats`. The 'user_num' column of `df`, if any, is
+    carried over.
+    """
+    columns = ["created_at", "end", "n_reports", "lat", "lng"]
+    if "user_num" in df:
+        columns = ["user_num"] + columns
+    stays = [s for uid, s in iter_stays(df, distance, duration) if s is not None]
+    if not stays:
+        return pd.DataFrame(columns=columns, index=pd.Index([], name="user_id"))
+    return pd.concat(stays)
+
+#-------------------------------------------------------------------------------
+
+def interpolate_great_circle(lat1, lng1, lat2, lng2, f):
+    """
+    Points at fractions `f` of the great-circle arcs between the points 1
+    and 2 (all arrays, in degrees). The points must not coincide.
+    """
+    lat1, lng1, lat2, lng2 = [np.radians(a) for a in (lat1, lng1, lat2, lng2)]
+    a = np.array([np.cos(lat1) * np.cos(lng1), np.cos(lat1) * np.sin(lng1), np.sin(lat1)])
+    b = np.array([np.cos(lat2) * np.cos(lng2), np.cos(lat2) * np.sin(lng2), np.sin(lat2)])
+    omega = np.arccos(np.clip((a * b).sum(axis=0), -1.0, 1.0))
+    v = (np.sin((1 - f) * omega) * a + np.sin(f * omega) * b) / np.sin(omega)
+    lat = np.degrees(np.arctan2(v[2], np.sqrt(v[0] ** 2 + v[1] ** 2)))
+    lng = np.degrees(np.arctan2(v[1], v[0]))
+    return lat, lng
+
+def densify(df, step=0.5, max_gap=30, max_speed=120.0):
+    """
+    Insert virtual reports between the consecutive reports of each user, so
+    that users moving along the same path share more cells.
+
+    Virtual reports are spaced about `step` km apart along the great circle
+    between two reports, with linearly interpolated timestamps. Pairs of
+    reports more than `max_gap` minutes apart, or implying a speed above
+    `max_speed` km/h, are left alone.
+
+    Returns:
+        The reports of `df` plus the virtual ones, sorted by user and time,
+        with a boolean 'virtual' column (placed first, so that it is part of
+        the point metadata in the grids). Virtual reports have no other data
+        than the 'user_num' of their user, if `df` has that column.
+
+    Runtime: O(n * log(n) + v), where v is the number of virtual reports.
+    """
+    uids, starts, order = group_users(df, sort_time=True)
+    lat = np.asarray(df["lat"], dtype=np.float64)[order]
+    lng = np.asarray(df["lng"], dtype=np.float64)[order]
+    ts = to_ns(df["created_at"])[order]
+    user = np.repeat(np.arange(len(uids)), np.diff(starts))
+
+    d = haversine(lat[:-1], lng[:-1], lat[1:], lng[1:])
+    gap = (ts[1:] - ts[:-1]) / 3.6e12 # hours
+    with np.errstate(divide='ignore', invalid='ignore'):
+        plausible = (user[1:] == user[:-1]) & (gap <= max_gap / 60.0) & (d / gap <= max_speed)
+    m = np.where(plausible, np.ceil(d / step) - 1, 0).clip(0).astype(np.intp)
+
+    # k-th of the m[i] virtual reports between the reports i and i + 1
+    pair = np.repeat(np.arange(len(m)), m)
+    k = np.arange(len(pair)) - np.repeat(np.cumsum(m) - m, m)
+    f = (k + 1.0) / (m[pair] + 1)
+    vlat, vlng = interpolate_great_circle(lat[pair], lng[pair], lat[pair + 1], lng[pair + 1], f)
+    vts = ts[pair] + (f * (ts[pair + 1] - ts[pair])).astype(np.int64)
+
+    virtual = pd.DataFrame({"created_at": pd.to_datetime(vts), "lat": vlat, "lng": vlng},
+        index=pd.Index(uids[user[pair]], name="user_id"))
+    virtual["virtual"] = True
+    if "user_num" in df:
+        virtual["user_num"] = np.asarray(df["user_num"])[order][pair]
+    real = df.copy()
+    real["virtual"] = False
+    columns = ["virtual"] + [c for c in df.columns if c != "virtual"]
+    dense = pd.concat([real, virtual])[columns]
+    dense.index.name = "user_id"
+    return dense.iloc[group_users(dense, sort_time=True)[2]]
+
+#-------------------------------------------------------------------------------
+
+def _segment_distances(px, py, ax, ay, bx, by):
+    """Distances from the points p to the segments [a, b], in the plane."""
+    dx, dy = bx - ax, by - ay
+    norm = dx ** 2 + dy ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(norm > 0, ((px - ax) * dx + (py - ay) * dy) / norm, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+def simplify_mask(lat, lng, starts, tolerance):
+    """
+    Douglas-Peucker simplification of the paths of all users at once.
+
+    The segments still to split, of all users, are processed together: each
+    pass computes the distances of all their inner points at once and splits
+    every segment at its farthest point if that is more than `tolerance`
+    metres away. Distances are measured in an equirectangular projection
+    centered on each user's centroid.
+
+    Args:
+        lat, lng (numpy.ndarray): Coordinates laid out contiguously by user,
+            in path order.
+        starts (numpy.ndarray): Offsets of the reports of each user.
+        tolerance (float): Tolerance in metres.
+
+    Returns:
+        A boolean array flagging the points to keep. The first and last
+        points of each path are always kept.
+
+    Runtime: O(n * log(n)) on average, O(n^2) in the worst case.
+    """
+    n = len(lat)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    clat = geom_averages(lat, lng, starts)[0]
+    scale = np.cos(np.radians(clat))[segment_ids(starts)]
+    y = np.radians(lat) * EARTH_RADIUS * 1000
+    x = np.radians(lng) * EARTH_RADIUS * 1000 * scale
+
+    first, last = starts[:-1], starts[1:] - 1
+    keep[first] = keep[last] = True
+    inner = last - first >= 2
+    s, e = first[inner], last[inner]
+    while len(s):
+        lens = e - s - 1
+        offsets = np.cumsum(lens) - lens
+        owner = np.repeat(np.arange(len(s)), lens)
+        idx = s[owner] + 1 + np.arange(lens.sum()) - offsets[owner]
+        d = _segment_distances(x[idx], y[idx], x[s[owner]], y[s[owner]], x[e[owner]], y[e[owner]])
+        dmax = np.maximum.reduceat(d, offsets)
+        # farthest point of each segment (the first one on ties)
+        farthest = np.nonzero(d == dmax[owner])[0]
+        farthest = idx[farthest[np.unique(owner[farthest], return_index=True)[1]]]
+        split = dmax > tolerance
+        m = farthest[split]
+        keep[m] = True
+        s, e = np.concatenate((s[split], m)), np.concatenate((m, e[split]))
+        inner = e - s >= 2
+        s, e = s[inner], e[inner]
+    return keep
+
+def simplify(df, tolerance):
+    """
+    Simplify the path of each user (its reports in the order of `df`) with
+    the Douglas-Peucker algorithm, see `simplify_mask`.
+
+    Args:
+        df (pandas.DataFrame): Reports indexed by user.
+        tolerance (float): Tolerance in metres.
+
+    Returns:
+        The rows of `df` which are kept, in their original order.
+    """
+    uids, starts, order = group_users(df)
+    lat = np.asarray(df["lat"], dtype=np.float64)[order]
+    lng = np.asarray(df["lng"], dtype=np.float64)[order]
+    keep = np.zeros(len(df), dtype=bool)
+    keep[order] = simplify_mask(lat, lng, starts, tolerance)
+    return df[keep]
+
+#-------------------------------------------------------------------------------
@@ -9,6 +9,7 @@ import sys
 import inspect
 
 from operator import itemgetter
+from itertools import product
 from copy import deepcopy
 from pprint import pformat
 import datetime as dt
@@ -22,6 +23,7 @@ from geopy.geocoders import Nominatim
 from geopy.units import radians
 
 EPSILON = 1e-4 # 1m
+EARTH_RADIUS = 6371.009 # mean earth radius in km
 
 # Bearing (in degrees)
 NORTH = 0.0
@@ -72,14 +74,23 @@ def bbox_from_name(name):
     location = geolocator.geocode(name)
     return location.raw['boundingbox']
 
-def get_bbox(df):
+def get_bbox(df, sindex=None):
+    if sindex is not None:
+        return sindex.bbox
     north = df['lat'].max() + 1e-15
     south = df['lat'].min()
     east = df['lng'].max() + 1e-15
     west = df['lng'].min()
     return [west, south, east, north]
 
-def bound(df, bbox):
+def bound(df, bbox, sindex=None):
+    """
+    Restrict `df` to the reports inside `bbox`. If a `SpatialIndex` built on
+    `df` is given, the reports are looked up in the index instead of scanning
+    the whole frame.
+    """
+    if sindex is not None:
+        return df.iloc[sindex.query_bbox(bbox)]
     W, S, E, N = bbox
     return df[(df.lng >= W) & (df.lng < E)
             & (df.lat >= S) & (df.lat < N)]
@@ -88,14 +99,59 @@ def in_bounds(P, bbox):
     W, S, E, N = bbox
     return (S <= P[0] < N and W <= P[1] < E)
 
+def row_metadata(row):
+    """
+    Metadata of a report row (pandas.Series) for `Point`: the columns up to
+    'text' as laid out in the CSV files, or all but the coordinates.
+    """
+    if "text" in row.index:
+        return row.loc[:"text"].to_dict()
+    return row.drop(["lat", "lng", "icell"], errors="ignore").to_dict()
+
 # ------------------------------------------------------------------------------
 
-def get_timespan(df):
+def get_timespan(df, tindex=None):
+    if tindex is not None:
+        return tindex.timespan
     return (df.created_at.min(), df.created_at.max() + dt.timedelta(microseconds=1))
 
-def bound_time(df, timespan):
+def bound_time(df, timespan, tindex=None):
+    """
+    Restrict `df` to the reports inside `timespan`. If a `TimeIndex` built on
+    `df` is given, the time window is sliced by binary search instead of
+    scanning the whole frame.
+    """
+    if tindex is not None:
+        return df.iloc[tindex.query(timespan)]
     begin, end = timespan
-    return df[(begin <= df.created_at < end)]
+    return df[(df.created_at >= begin) & (df.created_at < end)]
+
+def bound_spacetime(df, bbox, timespan, sindex=None, tindex=None):
+    """Restrict `df` to the reports inside both `bbox` and `timespan`."""
+    if sindex is not None and tindex is not None:
+        return df.iloc[np.intersect1d(sindex.query_bbox(bbox), tindex.query(timespan))]
+    elif tindex is not None:
+        return bound(bound_time(df, timespan, tindex), bbox)
+    else:
+        return bound_time(bound(df, bbox, sindex), timespan)
+
+def rechunk(frames, chunksize):
+    """
+    Regroup an iterable of DataFrames into DataFrames of `chunksize` rows
+    (the last one may be smaller), holding at most one chunk in memory.
+    """
+    buf, n = [], 0
+    for frame in frames:
+        while len(frame):
+            head = frame.iloc[:chunksize - n]
+            frame = frame.iloc[len(head):]
+            buf.append(head)
+            n += len(head)
+            if n == chunksize:
+                yield pd.concat(buf)
+                buf, n = [], 0
+    if buf:
+        yield pd.concat(buf)
 
 def in_timespan(P, timespan):
     begin, end = timespan
@@ -104,14 +160,21 @@ def in_timespan(P, timespan):
     else:
         return (begin <= P < end)
 
-def get_dense_timespan(df, stdn=1.0):
-    dt_min = df.created_at.min()
-    deltas = df.created_at - dt_min
-    dmean = deltas.mean()
-    dstd = deltas.std()
+def get_dense_timespan(df, stdn=1.0, tindex=None):
+    if tindex is not None:
+        ts = tindex.ts
+        deltas = (ts - ts[0]).astype(np.float64)
+        dt_min = pd.Timestamp(int(ts[0]))
+        dmean = pd.Timedelta(nanoseconds=int(deltas.mean()))
+        dstd = pd.Timedelta(nanoseconds=int(deltas.std(ddof=1)))
+    else:
+        dt_min = df.created_at.min()
+        deltas = df.created_at - dt_min
+        dmean = deltas.mean()
+        dstd = deltas.std()
     begin = dt_min + dmean - stdn * dstd
     end = dt_min + dmean + stdn * dstd
-    minbegin, maxend = get_timespan(df)
+    minbegin, maxend = get_timespan(df, tindex)
     return (max(begin, minbegin), min(end, maxend))
 
 # ------------------------------------------------------------------------------
@@ -144,6 +207,17 @@ def lazyDistance(P, Q):
     sphericalCos = sin(latP) * sin(latQ) + cos(latP) * cos(latQ) * cos(lngQ - lngP)
     return Distance(acos(sphericalCos) * 6371)
 
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Vectorized great-circle distance in km between arrays of points (in
+    degrees). Arguments are broadcast against each other.
+    """
+    lat1, lng1, lat2, lng2 = [np.radians(np.asarray(a, dtype=np.float64))
+        for a in (lat1, lng1, lat2, lng2)]
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
 def sum_dist(P, d, bearing):
     Q = VincentyDistance(kilometers=d).destination(P, bearing)
     return (Q.latitude, Q.longitude)
@@ -170,6 +244,52 @@ def go_north(lat, lng, d, lazy=False):
 
 # ------------------------------------------------------------------------------
 
+def summed_area_table(a):
+    """
+    Return the summed-area table (integral image) of the n-dimensional array
+    `a`. The table has a leading row of zeros along each axis, so that
+    `sat[i, j]` is the sum of `a[:i, :j]`.
+
+    Runtime: O(N), where N is the size of `a`.
+    """
+    a = np.asarray(a)
+    sat = np.zeros(tuple(n + 1 for n in a.shape), dtype=np.int64)
+    sat[(slice(1, None),) * a.ndim] = a
+    for axis in range(a.ndim):
+        np.cumsum(sat, axis=axis, out=sat)
+    return sat
+
+def box_sum(sat, lo, hi):
+    """
+    Sum the cells in the boxes lo <= index < hi by inclusion-exclusion over
+    the corners of each box in the summed-area table `sat`.
+
+    Args:
+        sat (numpy.ndarray): Summed-area table, see `summed_area_table`.
+        lo, hi (array-like): Lower (inclusive) and upper (exclusive) cell
+            indices, either a single box of shape (ndim,) or a batch of boxes
+            of shape (k, ndim). Boxes are clipped to the table.
+
+    Returns:
+        An int for a single box, an array of k ints for a batch.
+
+    Runtime: O(k * 2^ndim)
+    """
+    single = np.ndim(lo) == 1
+    shape = np.array(sat.shape) - 1
+    lo = np.clip(np.atleast_2d(lo), 0, shape)
+    hi = np.clip(np.atleast_2d(hi), 0, shape)
+    hi = np.maximum(hi, lo) # empty boxes
+    ndim = sat.ndim
+    total = np.zeros(len(lo), dtype=np.int64)
+    for corner in product([0, 1], repeat=ndim):
+        index = tuple(hi[:, d] if c else lo[:, d] for d, c in enumerate(corner))
+        sign = -1 if (ndim - sum(corner)) % 2 else 1
+        total += sign * sat[index]
+    return int(total[0]) if single else total
+
+# ------------------------------------------------------------------------------
+
 class SparseArray(object):
     def __init__(self, dimension=2, default_value=0, shape=None):
         self.elements = {}
@@ -224,6 +344,14 @@ class SparseArray(object):
         else:
             raise ValueError("Cell %s is not empty" % index)
 
+    def extend(self, index, values):
+        if index not in self.elements:
+            self.elements[index] = list(values)
+        elif isinstance(self.elements[index], list):
+            self.elements[index].extend(values)
+        else:
+            raise ValueError("Cell %s is not empty" % index)
+
     def squash(self, d=0):
         """Project array supressing dimension `d`"""
         if self.dim == 2: